@@ -0,0 +1,112 @@
+import subprocess
+import threading
+import time
+import re
+
+# Matches "package/activity" inside focus lines such as
+# "mCurrentFocus=Window{1a2b3c u0 com.example.app/com.example.app.MainActivity}"
+ACTIVITY_PATTERN = re.compile(r'([A-Za-z0-9_.]+)/([A-Za-z0-9_.$]+)')
+
+
+class ActivityTracker:
+    """Track foreground activity in the background and serve a cached value
+
+    Instead of dumping the whole activity stack for every step, the tracker
+    queries the focused window (filtered on the device side) only after it has
+    been told that focus may have changed, e.g. after a touch or key release.
+    Each invalidation gets a generation number, readers can wait for a refresh
+    covering it so a step never gets the activity of the previous screen.
+    """
+
+    def __init__(self, device_id="", settle_delay=0.5):
+        self.device_id = device_id
+        self.settle_delay = settle_delay  # Wait for window transition before querying
+        self.current_activity = None
+        self.running = False
+
+        self._dirty = threading.Event()
+        self._lock = threading.Lock()
+        self._refreshed = threading.Condition(self._lock)
+        self._requested = 0  # Generation of the newest invalidation
+        self._completed = 0  # Generation covered by the cached value
+        self._thread = None
+
+    def start(self):
+        """Start background refresh thread"""
+        if self.running:
+            return
+        self.running = True
+        self.invalidate()  # Query once at startup
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop background refresh thread"""
+        self.running = False
+        self._dirty.set()
+        with self._lock:
+            self._refreshed.notify_all()
+
+    def invalidate(self):
+        """Mark cached activity as stale and schedule a refresh, return its generation"""
+        with self._lock:
+            self._requested += 1
+            generation = self._requested
+        self._dirty.set()
+        return generation
+
+    def get_current_activity(self, generation=None, timeout=None):
+        """Return cached activity without querying the device
+
+        The value must cover `generation` (default: the newest invalidation),
+        waiting up to `timeout` seconds for the refresh. None if it is stale.
+        """
+        with self._lock:
+            if generation is None:
+                generation = self._requested
+            if timeout:
+                self._refreshed.wait_for(lambda: self._completed >= generation or not self.running,
+                                         timeout)
+            if self._completed < generation:
+                return None
+            return self.current_activity
+
+    def _run(self):
+        """Refresh cached activity each time it is invalidated"""
+        while self.running:
+            self._dirty.wait()
+            if not self.running:
+                break
+            # Let the window transition settle, coalescing bursts of events
+            time.sleep(self.settle_delay)
+            self._dirty.clear()
+            with self._lock:
+                generation = self._requested
+
+            activity = self.query_focused_activity()
+            with self._lock:
+                # A failed query leaves no valid value, like querying per step did
+                self.current_activity = activity
+                self._completed = generation
+                self._refreshed.notify_all()
+
+    def query_focused_activity(self):
+        """Query focused window, filtering dumpsys output on the device side"""
+        try:
+            cmd = (f"adb {self.device_id} shell "
+                   f"\"dumpsys window | grep -E 'mCurrentFocus|mFocusedApp'\"")
+            output = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL).decode()
+            return self.parse_focus_output(output)
+        except Exception:
+            return None
+
+    @staticmethod
+    def parse_focus_output(output):
+        """Extract "package/activity" from focus lines, preferring mCurrentFocus"""
+        lines = output.splitlines()
+        lines.sort(key=lambda line: 'mCurrentFocus' not in line)
+        for line in lines:
+            match = ACTIVITY_PATTERN.search(line)
+            if match:
+                return match.group(0)
+        return None
@@ -0,0 +1,267 @@
+import contextlib
+import json
+import os
+import shutil
+import threading
+
+STAGING_DIRNAME = ".staging"
+MANIFEST_FILENAME = "MANIFEST.json"
+
+
+def _fsync_dir(path):
+    """Persist directory entries (renames), not supported on every platform"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w', encoding='utf-8'):
+    """Open temporary file that replaces `path` only once fully written and synced"""
+    temp_path = f"{path}.tmp"
+    kwargs = {} if 'b' in mode else {"encoding": encoding}
+    with open(temp_path, mode, **kwargs) as f:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    _fsync_dir(os.path.dirname(path) or ".")
+
+
+def _apply_manifest(record_path, batch_dir, manifest):
+    """Move staged files into place and apply deletions, safe to repeat"""
+    touched_dirs = set()
+    for staged_name, relpath in manifest["writes"]:
+        staged_path = os.path.join(batch_dir, staged_name)
+        final_path = os.path.join(record_path, relpath)
+        # Already moved if a previous apply was interrupted
+        if os.path.exists(staged_path):
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(staged_path, final_path)
+            touched_dirs.add(os.path.dirname(final_path))
+    for relpath in manifest["deletes"]:
+        final_path = os.path.join(record_path, relpath)
+        if os.path.exists(final_path):
+            os.remove(final_path)
+            touched_dirs.add(os.path.dirname(final_path))
+    for path in touched_dirs:
+        _fsync_dir(path)
+
+
+def recover_record(record_path):
+    """Finish committed batches and discard partial ones left by a crash"""
+    staging_dir = os.path.join(record_path, STAGING_DIRNAME)
+    if not os.path.isdir(staging_dir):
+        return
+    for name in sorted(os.listdir(staging_dir)):
+        batch_dir = os.path.join(staging_dir, name)
+        manifest_path = os.path.join(batch_dir, MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                _apply_manifest(record_path, batch_dir, json.load(f))
+            print(f"Recovered committed steps in {record_path}")
+        else:
+            print(f"Discarded partial steps in {record_path}")
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+def recover_records(record_dir):
+    """Recover all record directories, run on startup"""
+    if not os.path.isdir(record_dir):
+        return
+    for name in os.listdir(record_dir):
+        record_path = os.path.join(record_dir, name)
+        if os.path.isdir(os.path.join(record_path, STAGING_DIRNAME)):
+            recover_record(record_path)
+
+
+class StepArtifactWriter:
+    """Stage step artifacts in memory and commit them to disk atomically in groups
+
+    Writes and deletions of one step are collected until commit(), which makes
+    them a unit. A background thread flushes committed units every
+    `flush_interval` seconds as one batch: staged files are written and
+    fsynced, a manifest is atomically published as commit point, then files
+    are renamed into place. After a crash, recover_record() rolls batches with
+    a manifest forward and drops the rest, so a step is either complete or
+    absent. Files appended outside the writer can be registered with
+    sync_file(), they are fsynced before the manifest of their batch.
+    Pending artifacts can be read back through read() before they reach disk.
+    """
+
+    def __init__(self, record_path, flush_interval=1.0):
+        self.record_path = record_path
+        self.flush_interval = flush_interval
+        recover_record(record_path)
+
+        self._lock = threading.Lock()
+        self._open = {}  # Current step: relpath -> bytes, None for deletion
+        self._committed = {}  # Committed steps waiting for flush
+        self._flushing = {}  # Batch being written
+        # Existing files to fsync with the open, committed and flushing steps
+        self._open_syncs = set()
+        self._committed_syncs = set()
+        self._flushing_syncs = set()
+        self._batch_id = 0
+        self._failures = 0  # Number of failed batch writes
+        self._last_error = None
+
+        self._wake = threading.Event()
+        self._flushed = threading.Condition(self._lock)
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, relpath, data):
+        with self._lock:
+            self._open[relpath] = data
+
+    def delete(self, relpath):
+        with self._lock:
+            self._open[relpath] = None
+
+    def sync_file(self, relpath):
+        """Fsync file written elsewhere before the current step reaches disk"""
+        with self._lock:
+            self._open_syncs.add(relpath)
+
+    def commit(self):
+        """Close current step, its artifacts are flushed together"""
+        with self._lock:
+            self._committed.update(self._open)
+            self._committed_syncs.update(self._open_syncs)
+            self._open = {}
+            self._open_syncs = set()
+
+    def _pending(self):
+        return self._committed or self._committed_syncs or self._flushing or self._flushing_syncs
+
+    def _lookup(self, relpath):
+        """Pending state of relpath: (True, bytes or None) or (False, None) if not pending"""
+        for pending in (self._open, self._committed, self._flushing):
+            if relpath in pending:
+                return True, pending[relpath]
+        return False, None
+
+    def read(self, relpath):
+        """Read artifact, including not yet flushed ones"""
+        with self._lock:
+            pending, data = self._lookup(relpath)
+        if pending:
+            if data is None:
+                raise FileNotFoundError(relpath)
+            return data
+        with open(os.path.join(self.record_path, relpath), 'rb') as f:
+            return f.read()
+
+    def exists(self, relpath):
+        with self._lock:
+            pending, data = self._lookup(relpath)
+        if pending:
+            return data is not None
+        return os.path.exists(os.path.join(self.record_path, relpath))
+
+    def flush(self):
+        """Flush committed steps now and wait until they are on disk
+
+        Raises OSError if they could not be written, they stay pending and are
+        retried by the background thread.
+        """
+        with self._lock:
+            failures = self._failures
+            while self._pending():
+                if self._failures != failures:
+                    raise OSError(f"Could not write step artifacts of {self.record_path}: {self._last_error}")
+                self._wake.set()
+                self._flushed.wait()
+
+    def close(self):
+        """Flush committed steps and stop, uncommitted artifacts are dropped
+
+        Raises OSError and keeps running if committed steps could not be written.
+        """
+        self.flush()
+        self.running = False
+        self._wake.set()
+        self._thread.join()
+        try:
+            os.rmdir(os.path.join(self.record_path, STAGING_DIRNAME))
+        except OSError:
+            pass
+
+    def _run(self):
+        while self.running:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+
+            with self._lock:
+                if not self._committed and not self._committed_syncs:
+                    continue
+                self._flushing = self._committed
+                self._flushing_syncs = self._committed_syncs
+                self._committed = {}
+                self._committed_syncs = set()
+
+            try:
+                self._write_batch(self._flushing, self._flushing_syncs)
+            except Exception as e:
+                print(f"Error writing step artifacts: {e}")
+                # Keep batch pending, retried with the next flush
+                with self._lock:
+                    # Steps committed meanwhile are newer and take precedence
+                    self._flushing.update(self._committed)
+                    self._committed = self._flushing
+                    self._flushing = {}
+                    self._committed_syncs |= self._flushing_syncs
+                    self._flushing_syncs = set()
+                    self._failures += 1
+                    self._last_error = e
+                    self._flushed.notify_all()
+                continue
+
+            with self._lock:
+                self._flushing = {}
+                self._flushing_syncs = set()
+                self._flushed.notify_all()
+
+    def _write_batch(self, operations, syncs=()):
+        """Write batch with staging files and manifest as commit point"""
+        self._batch_id += 1
+        batch_dir = os.path.join(self.record_path, STAGING_DIRNAME, f"batch_{self._batch_id:08d}")
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        os.makedirs(batch_dir)
+
+        try:
+            manifest = {"writes": [], "deletes": []}
+            for index, (relpath, data) in enumerate(operations.items()):
+                if data is None:
+                    manifest["deletes"].append(relpath)
+                    continue
+                staged_name = f"{index}.bin"
+                with open(os.path.join(batch_dir, staged_name), 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                manifest["writes"].append([staged_name, relpath])
+            for relpath in syncs:
+                fd = os.open(os.path.join(self.record_path, relpath), os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+            with atomic_open(os.path.join(batch_dir, MANIFEST_FILENAME)) as f:
+                json.dump(manifest, f)
+
+            _apply_manifest(self.record_path, batch_dir, manifest)
+        finally:
+            # On failure the whole batch is rewritten by the retry, a stale
+            # manifest must not be replayed over newer data on recovery
+            shutil.rmtree(batch_dir, ignore_errors=True)
@@ -0,0 +1,201 @@
+import subprocess
+import threading
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# Profiles are shared by all recording sessions on this host
+PROFILE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".mobile_trace_collector", "device_profiles")
+PROFILE_VERSION = 1
+
+
+class DeviceProfile:
+    """Static properties of a device needed for recording"""
+
+    def __init__(self, serial, validation_key, screen_width, screen_height,
+                 max_x=32767, max_y=32767, max_pressure=None, max_slot=None,
+                 touch_device=None, supports_exec_out=False, supports_ui_stream=False):
+        self.serial = serial
+        self.validation_key = validation_key  # Build fingerprint, display size and boot id
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.max_x = max_x
+        self.max_y = max_y
+        self.max_pressure = max_pressure
+        self.max_slot = max_slot
+        self.touch_device = touch_device  # Input device node, e.g. /dev/input/event2
+        self.supports_exec_out = supports_exec_out
+        self.supports_ui_stream = supports_ui_stream  # uiautomator dump /dev/tty
+
+    def to_dict(self):
+        data = dict(self.__dict__)
+        data["version"] = PROFILE_VERSION
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        if data.pop("version", None) != PROFILE_VERSION:
+            return None
+        return cls(**data)
+
+
+def _adb(device_id, args, timeout=30, adb="adb"):
+    """Run adb command and return decoded output, `adb` is the executable to use"""
+    cmd = f"\"{adb}\" {device_id} {args}"
+    output = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL, timeout=timeout)
+    return output.decode(errors='replace')
+
+
+def get_serial(device_id="", adb="adb"):
+    """Get serial number of device selected by adb arguments"""
+    return _adb(device_id, "get-serialno", adb=adb).strip()
+
+
+def get_validation_key(device_id="", adb="adb"):
+    """Cheap single round trip identifying build, display configuration and boot
+
+    Input device nodes are numbered at boot and can change across reboots, so
+    the boot id makes the cached profile valid for the current boot only.
+    """
+    output = _adb(device_id, "shell \"getprop ro.build.fingerprint; wm size; "
+                             "cat /proc/sys/kernel/random/boot_id 2>/dev/null\"", adb=adb)
+    return " | ".join(line.strip() for line in output.splitlines() if line.strip())
+
+
+def parse_screen_size(output):
+    """Parse `wm size` output, override size takes precedence"""
+    sizes = re.findall(r'(\d+)x(\d+)', output)
+    width, height = sizes[-1]
+    return int(width), int(height)
+
+
+def parse_input_devices(output):
+    """Parse `getevent -lp` output, return touch device node and axis ranges"""
+    info = {"touch_device": None, "max_x": 32767, "max_y": 32767,
+            "max_pressure": None, "max_slot": None}
+    device = None
+    found = False
+    for line in output.split('\n'):
+        if line.startswith('add device'):
+            # A touch screen was already found, ignore remaining devices
+            if found:
+                break
+            device = line.split(':', 1)[1].strip()
+            continue
+        match = re.search(r'max (\d+)', line)
+        if not match:
+            continue
+        value = int(match.group(1))
+        if 'ABS_MT_POSITION_X' in line:
+            info["max_x"] = value
+            info["touch_device"] = device
+            found = True
+        elif 'ABS_MT_POSITION_Y' in line:
+            info["max_y"] = value
+        elif 'ABS_MT_PRESSURE' in line:
+            info["max_pressure"] = value
+        elif 'ABS_MT_SLOT' in line:
+            info["max_slot"] = value
+    return info
+
+
+def probe_device_profile(device_id="", serial=None, validation_key=None, adb="adb"):
+    """Probe device for a fresh profile"""
+    serial = serial or get_serial(device_id, adb)
+    validation_key = validation_key or get_validation_key(device_id, adb)
+
+    screen_width, screen_height = parse_screen_size(_adb(device_id, "shell wm size", adb=adb))
+    input_info = parse_input_devices(_adb(device_id, "shell getevent -lp", adb=adb))
+
+    # Check capabilities used to avoid temporary files on the device and host
+    try:
+        supports_exec_out = _adb(device_id, "exec-out echo ok", adb=adb).strip() == "ok"
+    except Exception:
+        supports_exec_out = False
+    try:
+        supports_ui_stream = supports_exec_out and "<hierarchy" in _adb(
+            device_id, "exec-out uiautomator dump /dev/tty", adb=adb)
+    except Exception:
+        supports_ui_stream = False
+
+    return DeviceProfile(serial, validation_key, screen_width, screen_height,
+                         supports_exec_out=supports_exec_out,
+                         supports_ui_stream=supports_ui_stream, **input_info)
+
+
+def _profile_path(serial, cache_dir):
+    safe_serial = re.sub(r'[^A-Za-z0-9_.-]', '_', serial)
+    return os.path.join(cache_dir, f"{safe_serial}.json")
+
+
+def load_cached_profile(serial, cache_dir=PROFILE_CACHE_DIR):
+    """Load cached profile for serial, None if missing or unreadable"""
+    try:
+        with open(_profile_path(serial, cache_dir), 'r', encoding='utf-8') as f:
+            return DeviceProfile.from_dict(json.load(f))
+    except Exception:
+        return None
+
+
+def save_profile(profile, cache_dir=PROFILE_CACHE_DIR):
+    """Save profile to cache"""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = _profile_path(profile.serial, cache_dir)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(profile.to_dict(), f, indent=4, ensure_ascii=False)
+        os.replace(temp_path, path)
+    except Exception as e:
+        print(f"Error saving device profile: {e}")
+
+
+def load_device_profile(device_id="", cache_dir=PROFILE_CACHE_DIR, adb="adb"):
+    """Get device profile, using cache when build, display and boot are unchanged"""
+    serial = get_serial(device_id, adb)
+    validation_key = get_validation_key(device_id, adb)
+
+    profile = load_cached_profile(serial, cache_dir)
+    if profile and profile.validation_key == validation_key:
+        return profile
+
+    profile = probe_device_profile(device_id, serial, validation_key, adb)
+    save_profile(profile, cache_dir)
+    return profile
+
+
+def load_device_profile_async(device_id, callback, cache_dir=PROFILE_CACHE_DIR):
+    """Load device profile in background thread, callback receives (profile, error)"""
+    def run():
+        try:
+            profile = load_device_profile(device_id, cache_dir)
+        except Exception as e:
+            callback(None, e)
+            return
+        callback(profile, None)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def load_device_profiles(device_ids, cache_dir=PROFILE_CACHE_DIR, adb="adb"):
+    """Load profiles of several devices in parallel, return {device_id: profile}
+
+    Devices whose profile cannot be loaded are reported and left out.
+    """
+    if not device_ids:
+        return {}
+
+    def load(device_id):
+        try:
+            return load_device_profile(device_id, cache_dir, adb)
+        except Exception as e:
+            print(f"Error loading device profile of {device_id}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=len(device_ids)) as executor:
+        profiles = dict(zip(device_ids, executor.map(load, device_ids)))
+    return {device_id: profile for device_id, profile in profiles.items() if profile}
@@ -3,10 +3,20 @@ import threading
 import time
 from datetime import datetime
 import json
+import io
 import os
 import re
+import shutil
+import tempfile
+import argparse
 import tkinter as tk
 from recorder_gui import RecorderGUI
+from activity_tracker import ActivityTracker
+from device_profile import load_device_profile_async
+from touch_tracker import TouchTracker, pack_trajectories
+from step_store import StepStore, SPILL_FILENAME
+from state_graph import StateGraph, ui_fingerprint, action_key
+from artifact_writer import StepArtifactWriter, recover_records
 from PIL import Image, ImageDraw, ImageFont
 import math
 
@@ -15,24 +25,28 @@ def print_with_timestamp(message):
     print(f'[{timestamp}] {message}')
 
 class AndroidEventMonitor:
-    def __init__(self, device_id=""):
+    def __init__(self, device_id="", long_session_window=None, skip_redundant_captures=False,
+                 flush_interval=1.0):
         self.device_id = device_id
         self.process = None
         self.running = False
         
-        # Initialize device information
-        self.screen_width, self.screen_height = self.get_screen_resolution()
-        self.max_x, self.max_y = self.get_touch_range()
-
-        # Add new member variables to track touch events
-        self.current_x = None
-        self.current_y = None
-        self.last_event_time = None
-        self.touch_start_time = None  # Add: record touch start time
-        self.is_continuous = False
-        self.start_point = None
-        self.time_threshold = 0.1  # 100ms threshold for continuous events
+        # Device information, loaded in background by start_monitoring
+        self.profile = None
+        self.profile_error = None  # Set with profile_ready when loading failed
+        self.profile_ready = threading.Event()
+        self.screen_width = self.screen_height = None
+        self.max_x = self.max_y = None
+
+        # Foreground activity is refreshed in background and cached per step
+        self.activity_tracker = ActivityTracker(device_id)
+        self.activity_timeout = 2.0  # Max wait for a refresh after the step's own event
+
+        # Touch contacts are tracked per slot, a gesture ends when all fingers are lifted
+        self.touch_tracker = TouchTracker(self._process_touch_sequence)
         self.press_threshold = 0.6  # 600ms threshold for long press events
+        self.move_threshold = 10  # Pixels a contact may move and still count as stationary
+        self.trajectory_tolerance = 2.0  # Douglas-Peucker tolerance in pixels for saved trajectories
 
         # Modify key-related member variables
         self.current_key = None
@@ -41,40 +55,68 @@ class AndroidEventMonitor:
         self.special_keys = {'KEY_BACK', 'KEY_HOME', 'KEY_APPSELECT', 'KEY_ENTER'}
 
         # Modify action recording related member variables
-        self.actions = []
+        # Long-session mode keeps only the last `long_session_window` steps in memory
+        self.long_session_window = long_session_window
+        self.actions = StepStore()
         self.step_id = 0
         self.record_timestamp = None  # Initialize as None
         self.record_dir = "records"
+        self.record_path = None  # Initialize as None
         self.screenshots_dir = None  # Initialize as None
         self.ui_trees_dir = None  # Initialize as None
         self.processed_screenshots_dir = None  # Initialize as None
+        self.trajectories_dir = None  # Initialize as None
+
+        # Step artifacts are staged in memory and committed to disk in background
+        self.writer = None
+        # Held while a step is captured, finishing or editing the path waits for it
+        self.step_lock = threading.RLock()
+        self.flush_interval = flush_interval
+        # Finish steps committed before a previous run was interrupted
+        recover_records(self.record_dir)
+
+        # UI states and transitions shared by all sessions
+        self.state_graph = StateGraph(os.path.join(self.record_dir, "state_graph"))
+        self.initial_ui_state = None
+        self.last_ui_state = None
+        # Skip screenshots of steps repeating an already recorded transition
+        self.skip_redundant_captures = skip_redundant_captures
 
         self.gui = None  # Add GUI reference
         self.path_target = None  # Add path target variable
         self.recording_enabled = False  # Add flag to control recording
 
-    def get_screen_resolution(self):
-        """Get device screen resolution"""
-        cmd = f"adb {self.device_id} shell wm size"
-        output = subprocess.check_output(cmd, shell=True).decode()
-        resolution = output.split()[-1].split('x')
-        return int(resolution[0]), int(resolution[1])
-
-    def get_touch_range(self):
-        """Get touch screen coordinate range"""
-        cmd = f"adb {self.device_id} shell getevent -p"
-        output = subprocess.check_output(cmd, shell=True).decode()
-        max_x = max_y = 32767  # Default value (some devices)
-        for line in output.split('\n'):
-            if 'ABS_MT_POSITION_X' in line:
-                max_x = int(line.split('max ')[1])
-            elif 'ABS_MT_POSITION_Y' in line:
-                max_y = int(line.split('max ')[1])
-        return max_x, max_y
+    def _on_profile_loaded(self, profile, error):
+        """Apply device profile and start reading events"""
+        if error:
+            print_with_timestamp(f"Error loading device profile: {error}")
+            self.profile_error = error
+            self.profile_ready.set()
+            return
+
+        self.profile = profile
+        self.screen_width, self.screen_height = profile.screen_width, profile.screen_height
+        self.max_x, self.max_y = profile.max_x, profile.max_y
+        self.touch_tracker.set_scale(self.max_x, self.max_y, self.screen_width, self.screen_height)
+        self.profile_ready.set()
+        print_with_timestamp(f"Device {profile.serial} ready: {self.screen_width}x{self.screen_height}")
+
+        if self.running:
+            self._start_event_reader()
 
     def start_monitoring(self):
-        """Start event monitoring thread"""
+        """Start event monitoring, device profile is loaded without blocking the caller"""
         self.running = True
+        self.activity_tracker.start()
+        self._load_profile()
+
+    def _load_profile(self):
+        self.profile_error = None
+        self.profile_ready.clear()
+        load_device_profile_async(self.device_id, self._on_profile_loaded)
+
+    def _start_event_reader(self):
+        """Start event monitoring thread"""
         cmd = f"adb {self.device_id} shell getevent -lt"
         self.process = subprocess.Popen(
             cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
@@ -86,7 +128,11 @@ class AndroidEventMonitor:
         while self.running:
             line = self.process.stdout.readline().decode().strip()
             if line:
-                self.parse_event(line)
+                try:
+                    self.parse_event(line)
+                except Exception as e:
+                    # Keep reading events, a failed step must not stop recording
+                    print(f"Error processing event: {e}")
 
     def parse_event(self, line):
         """Parse single line event"""
@@ -106,6 +152,8 @@ class AndroidEventMonitor:
                 if action == 'DOWN':
                     self.current_key = key
                 elif action == 'UP' and self.current_key:
+                    # Key release may switch window focus
+                    self.activity_tracker.invalidate()
                     if self.current_key in self.special_keys:
                         self._output_pending_keys()
                         print_with_timestamp(f"[processed] {self.current_key}")
@@ -113,12 +161,9 @@ class AndroidEventMonitor:
                         self.step_id += 1
                         screenshot_name = f"step_{self.step_id}.png"
                         
-                        # Take screenshot first
-                        self.take_screenshot(os.path.join(self.screenshots_dir, f"step_{self.step_id}"))
-
                         print(f"This is a special event, current step_id is: {self.step_id}, screenshot path is: {screenshot_name}")
                         
-                        # Then record the step
+                        # Record the step
                         self._record_step({
                             "step_id": self.step_id,
                             "action_type": "special_event",
@@ -132,114 +177,138 @@ class AndroidEventMonitor:
                         self.pending_keys.append(self.current_key)
                     self.current_key = None
         
-        elif 'ABS_MT_POSITION_X' in line:
-            self._output_pending_keys()
-            hex_value = line.split()[-1]
-            self.current_x = self._convert_coord(hex_value, self.max_x, self.screen_width)
-            
-        elif 'ABS_MT_POSITION_Y' in line:
-            hex_value = line.split()[-1]
-            self.current_y = self._convert_coord(hex_value, self.max_y, self.screen_height)
-            
-            # If both X and Y coordinates are present, process
-            if self.current_x is not None:
-                if not self.is_continuous:
-                    # New touch sequence starts
-                    self.start_point = (self.current_x, self.current_y)
-                    self.is_continuous = True
-                    self.last_event_time = timestamp
-                    self.touch_start_time = timestamp  # Record touch start time
-                else:
-                    # Check if it is a continuous event
-                    time_diff = timestamp - self.last_event_time
-                    if time_diff > self.time_threshold:
-                        # Time interval too large
-                        self._process_touch_sequence(timestamp)
-                        self.start_point = (self.current_x, self.current_y)
-                        self.touch_start_time = timestamp
-                    
-                    self.last_event_time = timestamp
-
-        elif 'ABS_MT_TRACKING_ID' in line:
-            tracking_id = line.split()[-1]
-            if tracking_id == 'ffffffff':  # ACTION_UP
-                if self.is_continuous:
-                    self._process_touch_sequence(timestamp)
-                self.is_continuous = False
-                self.current_x = None
-                self.current_y = None
-                self.last_event_time = None
-                self.touch_start_time = None
-                self.start_point = None
-                print_with_timestamp("ACTION_UP")
-            else:  # ACTION_DOWN
-                print_with_timestamp("ACTION_DOWN")
-
-    def _convert_coord(self, hex_str, max_raw, screen_size):
-        """Convert coordinates to actual screen pixels"""
-        raw_value = int(hex_str, 16)
-        return int(raw_value * screen_size / max_raw)
-    
-    def _process_touch_sequence(self, current_timestamp):
-        """Process touch sequence, distinguish between click, long press and swipe"""
+        elif 'EV_ABS' in line or 'SYN_REPORT' in line or 'SYN_DROPPED' in line:
+            parts = line.split()
+            code, value = parts[-2], parts[-1]
+            if code == 'SYN_DROPPED':
+                print_with_timestamp("Events dropped, discarding current gesture")
+            if code == 'ABS_MT_TRACKING_ID':
+                if value == 'ffffffff':  # ACTION_UP
+                    # Touch release may switch window focus
+                    self.activity_tracker.invalidate()
+                    print_with_timestamp("ACTION_UP")
+                else:  # ACTION_DOWN
+                    # Touch ends pending text input
+                    self._output_pending_keys()
+                    print_with_timestamp("ACTION_DOWN")
+            self.touch_tracker.feed(timestamp, code, value)
+
+    def _process_touch_sequence(self, trajectories, end_timestamp):
+        """Process finished gesture, distinguish between click, long press, swipe and multi-touch"""
         self._output_pending_keys()
-        
-        if not self.start_point or not self.current_x or not self.current_y or not self.touch_start_time:
-            return
-            
-        start_x, start_y = self.start_point
-        end_x, end_y = self.current_x, self.current_y
-        
-        # Calculate movement distance and duration
-        distance = ((end_x - start_x) ** 2 + (end_y - start_y) ** 2) ** 0.5
-        duration = current_timestamp - self.touch_start_time
+
+        trajectories.sort(key=lambda trajectory: trajectory.t[0])
+        duration = end_timestamp - trajectories[0].t[0]
         
         self.step_id += 1
         screenshot_name = f"step_{self.step_id}.png"
         
-        if distance < 10:  # Stationary click
-            if duration >= self.press_threshold:
-                # Long press event
-                print_with_timestamp(f"[processed] Press at ({start_x}, {start_y})")
-                self._record_step({
-                    "step_id": self.step_id,
-                    "action_type": "press",
-                    "action_detail": {
-                        "x": start_x,
-                        "y": start_y,
-                        "duration": duration
-                    },
-                    "screen_shot": screenshot_name
-                })
+        if len(trajectories) > 1:
+            step_data = self._multi_touch_step(trajectories, duration)
+        else:
+            start_x, start_y = trajectories[0].start_point()
+            end_x, end_y = trajectories[0].end_point()
+            # Calculate movement distance
+            distance = ((end_x - start_x) ** 2 + (end_y - start_y) ** 2) ** 0.5
+
+            if distance < self.move_threshold:  # Stationary click
+                if duration >= self.press_threshold:
+                    # Long press event
+                    print_with_timestamp(f"[processed] Press at ({start_x}, {start_y})")
+                    step_data = {
+                        "step_id": self.step_id,
+                        "action_type": "press",
+                        "action_detail": {
+                            "x": start_x,
+                            "y": start_y,
+                            "duration": duration
+                        }
+                    }
+                else:
+                    # Normal click
+                    print_with_timestamp(f"[processed] Click at ({start_x}, {start_y})")
+                    step_data = {
+                        "step_id": self.step_id,
+                        "action_type": "click",
+                        "action_detail": {
+                            "x": start_x,
+                            "y": start_y
+                        }
+                    }
             else:
-                # Normal click
-                print_with_timestamp(f"[processed] Click at ({start_x}, {start_y})")
-                self._record_step({
+                # Swipe event
+                print_with_timestamp(f"[processed] Swipe from ({start_x}, {start_y}) to ({end_x}, {end_y})")
+                step_data = {
                     "step_id": self.step_id,
-                    "action_type": "click",
+                    "action_type": "swipe",
                     "action_detail": {
-                        "x": start_x,
-                        "y": start_y
-                    },
-                    "screen_shot": screenshot_name
-                })
-        else:
-            # Swipe event
-            print_with_timestamp(f"[processed] Swipe from ({start_x}, {start_y}) to ({end_x}, {end_y})")
-            self._record_step({
-                "step_id": self.step_id,
-                "action_type": "swipe",
-                "action_detail": {
-                    "start_x": start_x,
-                    "start_y": start_y,
-                    "end_x": end_x,
-                    "end_y": end_y,
-                    "duration": duration
-                },
-                "screen_shot": screenshot_name
+                        "start_x": start_x,
+                        "start_y": start_y,
+                        "end_x": end_x,
+                        "end_y": end_y,
+                        "duration": duration
+                    }
+                }
+        step_data["screen_shot"] = screenshot_name
+
+        trajectory_file = self._save_trajectories(trajectories)
+        if trajectory_file:
+            step_data["trajectory"] = trajectory_file
+
+        self._record_step(step_data)
+
+    def _multi_touch_step(self, trajectories, duration):
+        """Build multi-finger step, classify pinch by distance change of first two fingers"""
+        pointers = []
+        for trajectory in trajectories:
+            start_x, start_y = trajectory.start_point()
+            end_x, end_y = trajectory.end_point()
+            pointers.append({
+                "start_x": start_x,
+                "start_y": start_y,
+                "end_x": end_x,
+                "end_y": end_y
             })
-        
-        self.take_screenshot(os.path.join(self.screenshots_dir, f"step_{self.step_id}"))
+
+        first, second = pointers[0], pointers[1]
+        start_gap = math.hypot(first["start_x"] - second["start_x"], first["start_y"] - second["start_y"])
+        end_gap = math.hypot(first["end_x"] - second["end_x"], first["end_y"] - second["end_y"])
+        moved = any(math.hypot(p["end_x"] - p["start_x"], p["end_y"] - p["start_y"]) >= self.move_threshold
+                    for p in pointers)
+
+        if end_gap - start_gap >= self.move_threshold:
+            gesture = "pinch_out"
+        elif start_gap - end_gap >= self.move_threshold:
+            gesture = "pinch_in"
+        elif moved:
+            gesture = "multi_swipe"
+        else:
+            gesture = "multi_tap"
+
+        print_with_timestamp(f"[processed] {gesture} with {len(pointers)} fingers")
+        return {
+            "step_id": self.step_id,
+            "action_type": "multi_touch",
+            "action_detail": {
+                "gesture": gesture,
+                "pointers": pointers,
+                "duration": duration
+            }
+        }
+
+    def _save_trajectories(self, trajectories):
+        """Save simplified trajectories to binary sidecar, return file name"""
+        if not self.recording_enabled or not self.trajectories_dir:
+            return None
+        try:
+            simplified = [trajectory.simplified(self.trajectory_tolerance) for trajectory in trajectories]
+            trajectory_filename = f"step_{self.step_id}_touch.bin"
+            self._write_artifact(os.path.join(self.trajectories_dir, trajectory_filename),
+                                 pack_trajectories(simplified))
+            return trajectory_filename
+        except Exception as e:
+            print(f"Error saving trajectories: {e}")
+            return None
 
     def _output_pending_keys(self):
         """Output all pending key events"""
@@ -250,9 +319,6 @@ class AndroidEventMonitor:
             self.step_id += 1
             screenshot_name = f"step_{self.step_id}.png"
             
-            # Take screenshot first
-            self.take_screenshot(os.path.join(self.screenshots_dir, f"step_{self.step_id}"))
-            
             # Record step
             self._record_step({
                 "step_id": self.step_id,
@@ -281,15 +347,9 @@ class AndroidEventMonitor:
         x1, y1, x2, y2 = bounds
         return (x2 - x1) * (y2 - y1)
 
-    def _find_smallest_containing_bounds(self, xml_path, x, y):
+    def _find_smallest_containing_bounds(self, xml_content, x, y):
         """Find smallest bounds containing specified coordinates"""
         try:
-            if not os.path.exists(xml_path):
-                return None
-                
-            with open(xml_path, 'r', encoding='utf-8') as f:
-                xml_content = f.read()
-            
             # Find all bounds attributes
             bounds_pattern = r'bounds="(\[[0-9]+,[0-9]+\]\[[0-9]+,[0-9]+\])"'
             matches = re.finditer(bounds_pattern, xml_content)
@@ -315,11 +375,36 @@ class AndroidEventMonitor:
             print(f"Error finding bounds: {e}")
             return None
 
+    def _draw_swipe_arrow(self, draw, start_x, start_y, end_x, end_y, color, circle_radius):
+        """Draw start point, end point and arrow of a swipe"""
+        # Draw start point and end point circles
+        draw.ellipse([start_x-circle_radius, start_y-circle_radius, 
+                    start_x+circle_radius, start_y+circle_radius], 
+                   outline=color, width=2)
+        draw.ellipse([end_x-circle_radius, end_y-circle_radius, 
+                    end_x+circle_radius, end_y+circle_radius], 
+                   outline=color, width=2)
+        
+        # Draw arrow
+        draw.line([start_x, start_y, end_x, end_y], fill=color, width=2)
+        # Draw arrow head
+        arrow_length = 20
+        angle = math.atan2(end_y - start_y, end_x - start_x)
+        arrow_angle = math.pi / 6  # 30 degrees
+        draw.line([end_x, end_y,
+                  end_x - arrow_length * math.cos(angle + arrow_angle),
+                  end_y - arrow_length * math.sin(angle + arrow_angle)], 
+                 fill=color, width=2)
+        draw.line([end_x, end_y,
+                  end_x - arrow_length * math.cos(angle - arrow_angle),
+                  end_y - arrow_length * math.sin(angle - arrow_angle)], 
+                 fill=color, width=2)
+
     def process_screenshot(self, screenshot_path, step_data):
         """Process screenshot, add operation markers"""
         try:
             # Open original screenshot
-            img = Image.open(screenshot_path)
+            img = Image.open(io.BytesIO(self.read_artifact(screenshot_path)))
             draw = ImageDraw.Draw(img)
             
             # Set colors and font
@@ -351,33 +436,17 @@ class AndroidEventMonitor:
             
             elif action_type == "swipe":
                 # Draw swipe start point, end point and arrow
-                start_x = step_data["action_detail"]["start_x"]
-                start_y = step_data["action_detail"]["start_y"]
-                end_x = step_data["action_detail"]["end_x"]
-                end_y = step_data["action_detail"]["end_y"]
-                
-                # Draw start point and end point circles
-                draw.ellipse([start_x-circle_radius, start_y-circle_radius, 
-                            start_x+circle_radius, start_y+circle_radius], 
-                           outline=blue_color, width=2)
-                draw.ellipse([end_x-circle_radius, end_y-circle_radius, 
-                            end_x+circle_radius, end_y+circle_radius], 
-                           outline=blue_color, width=2)
-                
-                # Draw arrow
-                draw.line([start_x, start_y, end_x, end_y], fill=blue_color, width=2)
-                # Draw arrow head
-                arrow_length = 20
-                angle = math.atan2(end_y - start_y, end_x - start_x)
-                arrow_angle = math.pi / 6  # 30 degrees
-                draw.line([end_x, end_y,
-                          end_x - arrow_length * math.cos(angle + arrow_angle),
-                          end_y - arrow_length * math.sin(angle + arrow_angle)], 
-                         fill=blue_color, width=2)
-                draw.line([end_x, end_y,
-                          end_x - arrow_length * math.cos(angle - arrow_angle),
-                          end_y - arrow_length * math.sin(angle - arrow_angle)], 
-                         fill=blue_color, width=2)
+                detail = step_data["action_detail"]
+                self._draw_swipe_arrow(draw, detail["start_x"], detail["start_y"],
+                                       detail["end_x"], detail["end_y"], blue_color, circle_radius)
+            
+            elif action_type == "multi_touch":
+                # Draw one arrow per finger and gesture name at top
+                for pointer in step_data["action_detail"]["pointers"]:
+                    self._draw_swipe_arrow(draw, pointer["start_x"], pointer["start_y"],
+                                           pointer["end_x"], pointer["end_y"], blue_color, circle_radius)
+                text = f"Multi Touch: {step_data['action_detail']['gesture']}"
+                draw.text((10, 10), text, fill=red_color, font=font)
             
             elif action_type == "input":
                 # Draw input text at top
@@ -392,7 +461,9 @@ class AndroidEventMonitor:
             # Save processed image
             processed_filename = f"step_{step_data['step_id']}_processed.png"
             processed_path = os.path.join(self.processed_screenshots_dir, processed_filename)
-            img.save(processed_path)
+            buffer = io.BytesIO()
+            img.save(buffer, format='PNG')
+            self._write_artifact(processed_path, buffer.getvalue())
             
             # Return relative path
             return f"processed_screenshots/{processed_filename}"
@@ -402,10 +473,13 @@ class AndroidEventMonitor:
             return None
 
     def _record_step(self, step_data):
-        """Record single step"""
-        if not self.recording_enabled:
-            return
-            
+        """Record single step, unless recording has ended"""
+        with self.step_lock:
+            if self.recording_enabled:
+                self._capture_step(step_data)
+
+    def _capture_step(self, step_data):
+        """Capture activity, UI hierarchy and screenshots of step and save it"""
         # Wait 1 second to ensure page transition is complete
         time.sleep(1)
         
@@ -418,29 +492,36 @@ class AndroidEventMonitor:
         ui_tree = self.get_ui_hierarchy()
         if ui_tree:
             ui_tree_filename = f"step_{step_data['step_id']}_ui.xml"
-            ui_tree_path = os.path.join(self.ui_trees_dir, ui_tree_filename)
-            with open(ui_tree_path, 'w', encoding='utf-8') as f:
-                f.write(ui_tree)
+            self._write_artifact(os.path.join(self.ui_trees_dir, ui_tree_filename), ui_tree.encode('utf-8'))
             step_data["ui_tree"] = f"{ui_tree_filename}"
             
             # For click and long press operations, find corresponding bounds
             if step_data["action_type"] in ["click", "press"]:
                 x = step_data["action_detail"]["x"]
                 y = step_data["action_detail"]["y"]
-                bounds = self._find_smallest_containing_bounds(ui_tree_path, x, y)
+                bounds = self._find_smallest_containing_bounds(ui_tree, x, y)
                 if bounds:
                     step_data["operated_bounds"] = bounds
-        
-        # Process previous step's screenshot (if exists)
+
+            # Identify screen structure and record transition across sessions
+            self._record_ui_state(step_data, ui_fingerprint(ui_tree))
+        else:
+            self.last_ui_state = None
+
         prev_step_id = step_data['step_id'] - 1
-        if prev_step_id >= 0:
+        if step_data.get("redundant") and self.skip_redundant_captures:
+            # Transition already covered, UI tree is enough to follow the path
+            print_with_timestamp(f"[skipped] Processed screenshot of step {step_data['step_id']}, transition already recorded")
+            self._drop_redundant_screenshot(prev_step_id)
+        elif prev_step_id >= 0:
+            # Process previous step's screenshot (if exists)
             prev_screenshot = os.path.join(self.screenshots_dir, f"step_{prev_step_id}.png")
-            if os.path.exists(prev_screenshot):
+            if self.artifact_exists(prev_screenshot):
                 processed_path = self.process_screenshot(prev_screenshot, step_data)
                 if processed_path:
                     step_data["processed_screenshot"] = processed_path.replace("processed_screenshots/", "")
         
-        # Save current step's original screenshot
+        # Save current step's original screenshot, it is the before-image of the next step
         self.take_screenshot(os.path.join(self.screenshots_dir, f"step_{step_data['step_id']}"))
             
         self.actions.append(step_data)
@@ -448,89 +529,200 @@ class AndroidEventMonitor:
         
         # Update GUI display
         if self.gui:
-            self.gui.update_last_action(step_data)
-            self.gui.update_step_display(self.step_id)
+            self.gui.post_step(step_data, self.step_id)
+
+    def _drop_redundant_screenshot(self, step_id):
+        """Delete screenshot of a redundant step once the following step is redundant too
+
+        Its screen is already covered, it was only kept as before-image of the next step.
+        """
+        prev_action = self.actions.last()
+        if (prev_action and prev_action["step_id"] == step_id and prev_action.get("redundant")
+                and prev_action.get("screen_shot")):
+            screenshot_name = os.path.basename(prev_action.pop("screen_shot"))
+            self._delete_artifact(os.path.join(self.screenshots_dir, screenshot_name))
+
+    def _record_ui_state(self, step_data, ui_state):
+        """Add UI state and transition from previous state to state graph"""
+        if not ui_state:
+            self.last_ui_state = None
+            return
 
-    def _save_actions(self):
-        """Save all actions to JSON file"""
-        record_data = {
+        step_data["ui_state"] = ui_state
+        step_data["ui_state_seen"] = self.state_graph.has_state(ui_state)
+        if self.last_ui_state:
+            key = action_key(step_data)
+            if self.state_graph.has_transition(self.last_ui_state, key, ui_state):
+                step_data["redundant"] = True
+            self.state_graph.add_transition(self.last_ui_state, key, ui_state)
+
+        self.state_graph.add_state(ui_state, self._state_location(step_data['step_id']),
+                                   step_data.get("activity_info"))
+        self.last_ui_state = ui_state
+
+    def _state_location(self, step_id):
+        """Location of a step in the state graph"""
+        return f"record_{self.record_timestamp}/step_{step_id}"
+
+    def _write_artifact(self, path, data):
+        """Stage artifact of current step, written to disk when the step is committed
+
+        The writer is dropped when the path is finished, so each access takes one
+        reference and artifacts arriving after that are discarded.
+        """
+        writer = self.writer
+        if writer:
+            writer.write(os.path.relpath(path, self.record_path), data)
+
+    def _delete_artifact(self, path):
+        writer = self.writer
+        if writer:
+            writer.delete(os.path.relpath(path, self.record_path))
+
+    def read_artifact(self, path):
+        """Read artifact, including ones not yet flushed to disk"""
+        writer = self.writer
+        if writer:
+            return writer.read(os.path.relpath(path, self.record_path))
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def artifact_exists(self, path):
+        writer = self.writer
+        if writer:
+            return writer.exists(os.path.relpath(path, self.record_path))
+        return os.path.exists(path)
+
+    def _save_actions(self, final=False):
+        """Save all actions to JSON file and commit step artifacts as one unit
+
+        Spilled steps are only merged in when final.
+        """
+        header = {
             "target": self.path_target,
             "screen_size": {
                 "width": self.screen_width,
                 "height": self.screen_height
             },
-            "steps": self.actions
+            "initial_ui_state": self.initial_ui_state
         }
         
-        filename = os.path.join(self.record_dir, f"record_{self.record_timestamp}", "record.json")
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(record_data, f, indent=4, ensure_ascii=False)
+        filename = os.path.join(self.record_path, "record.json")
+        if final:
+            # Flush all committed steps before the complete record replaces the partial one,
+            # if they cannot be written this raises and the writer stays open for a retry
+            if self.writer:
+                self.writer.commit()
+                self.writer.close()
+                self.writer = None
+            self.actions.finish(filename, header)
+        else:
+            writer = self.writer
+            if not writer:
+                return
+            buffer = io.StringIO()
+            self.actions.write_record(buffer, header)
+            if self.actions.spilled_count:
+                # Synced by the writer thread, the record must not reference steps lost in a crash
+                writer.sync_file(SPILL_FILENAME)
+            writer.write(os.path.relpath(filename, self.record_path), buffer.getvalue().encode('utf-8'))
+            writer.commit()
+
+    def delete_last_step(self):
+        """Delete last resident step and its artifacts, return new last step"""
+        with self.step_lock:
+            return self._delete_last_step()
+
+    def _delete_last_step(self):
+        last_action = self.actions.pop()
+        if last_action is None:
+            return None
+        
+        # Delete all artifacts of the step, committed together with the updated record
+        if last_action.get('screen_shot'):
+            self._delete_artifact(os.path.join(self.screenshots_dir, os.path.basename(last_action['screen_shot'])))
+        if last_action.get('ui_tree'):
+            self._delete_artifact(os.path.join(self.ui_trees_dir, last_action['ui_tree']))
+        if last_action.get('processed_screenshot'):
+            self._delete_artifact(os.path.join(self.processed_screenshots_dir, last_action['processed_screenshot']))
+        if last_action.get('trajectory'):
+            self._delete_artifact(os.path.join(self.trajectories_dir, last_action['trajectory']))
+        
+        # Forget state visit and transition of deleted step, previous step may already be spilled
+        prev_action = self.actions.last_recorded()
+        prev_ui_state = prev_action.get("ui_state") if prev_action else self.initial_ui_state
+        if last_action.get("ui_state"):
+            self.state_graph.remove_state(last_action["ui_state"], self._state_location(last_action["step_id"]))
+            if prev_ui_state:
+                self.state_graph.remove_transition(prev_ui_state, action_key(last_action), last_action["ui_state"])
+        self.last_ui_state = prev_ui_state
+        
+        self.step_id -= 1
+        self._save_actions()
+        return self.actions.last()
+
+    def get_metrics(self):
+        """Step counts and resident memory for long sessions"""
+        return self.actions.get_metrics()
 
     def take_screenshot(self, filename):
-        """Take screenshot"""
+        """Take screenshot, staged as part of current step"""
+        if not self.writer:
+            return False
         try:
-            # Use temporary file name
-            temp_file = f"{filename}_temp.png"
-            # Use -o parameter to output directly to file, not using redirection
-            cmd = f"adb {self.device_id} exec-out screencap -p > \"{temp_file}\""
-            subprocess.run(cmd, shell=True, check=True)
-            
-            # Ensure file writing is complete
-            time.sleep(0.5)
-            
-            # If file exists and size is normal, rename it to final file name
-            if os.path.exists(temp_file) and os.path.getsize(temp_file) > 0:
-                final_file = f"{filename}.png"
-                # If target file exists, delete it first
-                if os.path.exists(final_file):
-                    os.remove(final_file)
-                os.rename(temp_file, final_file)
-                return True
+            if self.profile and not self.profile.supports_exec_out:
+                data = self._pull_screenshot()
             else:
-                print(f"Screenshot failed: {temp_file} not created or empty")
+                cmd = f"adb {self.device_id} exec-out screencap -p"
+                data = subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE).stdout
+            
+            # Empty or truncated output if the adb link was lost
+            if not data.startswith(b'\x89PNG'):
+                print(f"Screenshot failed: {filename}.png empty or invalid")
                 return False
+            self._write_artifact(f"{filename}.png", data)
+            return True
         except Exception as e:
             print(f"Error taking screenshot: {e}")
-            # Clean up possible temporary files
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
             return False
 
+    def _pull_screenshot(self):
+        """Capture through a file on the device, for devices without exec-out"""
+        device_file = "/sdcard/screen_capture.png"
+        subprocess.run(f"adb {self.device_id} shell screencap -p {device_file}", shell=True, check=True)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            local_file = os.path.join(temp_dir, "screen_capture.png")
+            subprocess.run(f"adb {self.device_id} pull {device_file} \"{local_file}\"",
+                           shell=True, check=True, stdout=subprocess.DEVNULL)
+            with open(local_file, 'rb') as f:
+                return f.read()
+
     def get_current_activity(self):
-        """Get current Activity information"""
-        try:
-            cmd = f"adb {self.device_id} shell dumpsys activity activities | findstr topResumedActivity"
-            output = subprocess.check_output(cmd, shell=True).decode()
-            # Use regex to extract activity information
-            match = re.search(r'com\.[^/]+/[^\s}]+', output)
-            if match:
-                return match.group(0)
-            return None
-        except:
-            return None
+        """Get current Activity information (cached by activity tracker)
+
+        Waits for the refresh following the latest touch or key release, None if it is late.
+        """
+        return self.activity_tracker.get_current_activity(timeout=self.activity_timeout)
 
     def get_ui_hierarchy(self):
-        """Get current UI hierarchy"""
+        """Get current UI hierarchy, streamed from the device without temporary files on the host"""
         try:
+            if self.profile and self.profile.supports_ui_stream:
+                cmd = f"adb {self.device_id} exec-out uiautomator dump /dev/tty"
+                output = subprocess.check_output(cmd, shell=True).decode('utf-8', errors='replace')
+                # Output ends with a status message after the XML
+                if '<hierarchy' in output:
+                    return output[:output.rfind('>') + 1]
+                return None
+            
             # Export UI hierarchy to device
             dump_cmd = f"adb {self.device_id} shell uiautomator dump"
             subprocess.run(dump_cmd, shell=True, check=True)
             
-            # Create temporary file name
-            temp_xml = os.path.join(self.screenshots_dir, "temp_ui_dump.xml")
-            
-            # Pull file from device
-            pull_cmd = f"adb {self.device_id} pull /sdcard/window_dump.xml \"{temp_xml}\""
-            subprocess.run(pull_cmd, shell=True, check=True)
-            
-            # Read XML content
-            if os.path.exists(temp_xml):
-                with open(temp_xml, 'r', encoding='utf-8') as f:
-                    ui_tree = f.read()
-                # Delete temporary file
-                os.remove(temp_xml)
-                return ui_tree
-            return None
+            # Read file from device
+            channel = "shell" if self.profile and not self.profile.supports_exec_out else "exec-out"
+            cat_cmd = f"adb {self.device_id} {channel} cat /sdcard/window_dump.xml"
+            return subprocess.check_output(cat_cmd, shell=True).decode('utf-8')
         except Exception as e:
             print(f"Error getting UI hierarchy: {e}")
             return None
@@ -540,35 +732,62 @@ class AndroidEventMonitor:
         if not self.record_timestamp:
             self.record_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             
-        record_path = os.path.join(self.record_dir, f"record_{self.record_timestamp}")
+        self.record_path = record_path = os.path.join(self.record_dir, f"record_{self.record_timestamp}")
         self.screenshots_dir = os.path.join(record_path, "screenshots")
         self.ui_trees_dir = os.path.join(record_path, "ui_trees")
         self.processed_screenshots_dir = os.path.join(record_path, "processed_screenshots")
+        self.trajectories_dir = os.path.join(record_path, "trajectories")
         
         # Ensure all directories exist
         os.makedirs(self.screenshots_dir, exist_ok=True)
         os.makedirs(self.ui_trees_dir, exist_ok=True)
         os.makedirs(self.processed_screenshots_dir, exist_ok=True)
+        os.makedirs(self.trajectories_dir, exist_ok=True)
 
     def set_path_target(self, target):
-        """Set path target"""
+        """Set path target, initial page is captured in background"""
         self.path_target = target
         
+        # Retry a failed profile load, e.g. after the device was reconnected
+        if self.profile_error:
+            self._load_profile()
+        
         self.record_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         self._setup_record_dirs()
         
         # Initialize recording
-        self.actions = []
+        self.writer = StepArtifactWriter(self.record_path, self.flush_interval)
+        self.actions = StepStore(self.record_path, self.long_session_window)
         self.step_id = 0
         
+        threading.Thread(target=self._capture_initial_page, daemon=True).start()
+
+    def _capture_initial_page(self):
+        """Capture initial page and start recording"""
+        # Screen size is required for the record file
+        self.profile_ready.wait()
+        with self.step_lock:
+            if not self.writer:
+                # Path was finished before the device was ready
+                return
+            if self.profile_error:
+                self._abort_path(f"Cannot start recording, device profile failed to load: {self.profile_error}")
+                return
+            self._capture_initial_step()
+
+    def _capture_initial_step(self):
+        """Capture step 0 and enable recording"""
         # Take initial page and UI hierarchy
         self.take_screenshot(os.path.join(self.screenshots_dir, "step_0"))
         initial_ui = self.get_ui_hierarchy()
+        self.initial_ui_state = self.last_ui_state = None
         if initial_ui:
             # Save initial UI hierarchy
-            ui_file = os.path.join(self.ui_trees_dir, "step_0_ui.xml")
-            with open(ui_file, 'w', encoding='utf-8') as f:
-                f.write(initial_ui)
+            self._write_artifact(os.path.join(self.ui_trees_dir, "step_0_ui.xml"), initial_ui.encode('utf-8'))
+
+            self.initial_ui_state = self.last_ui_state = ui_fingerprint(initial_ui)
+            if self.initial_ui_state:
+                self.state_graph.add_state(self.initial_ui_state, self._state_location(0))
         
         self.recording_enabled = True
         self._save_actions()
@@ -576,9 +795,30 @@ class AndroidEventMonitor:
         if self.gui:
             self.gui.update_initial_screenshot(os.path.join(self.screenshots_dir, "step_0.png"))
 
+    def _abort_path(self, message):
+        """Discard path that failed before step 0 and let the user set the target again"""
+        print_with_timestamp(message)
+        writer, self.writer = self.writer, None
+        if writer:
+            writer.close()
+            # Nothing was captured yet, only the empty directory structure exists
+            shutil.rmtree(self.record_path, ignore_errors=True)
+        self.record_timestamp = None
+        self.actions = StepStore()
+        if self.gui:
+            self.gui.report_error(message)
+
     def finish_current_path(self):
-        self.recording_enabled = False
-        self._save_actions()
+        """Save complete record, a step still being captured is included
+
+        Raises OSError if step files cannot be written, the path then stays open.
+        """
+        with self.step_lock:
+            if self.record_timestamp:
+                self._save_actions(final=True)
+            self.recording_enabled = False
+            self.actions = StepStore()
+            self.step_id = 0
 
     def finish_current_input(self):
         if self.pending_keys:
@@ -586,9 +826,23 @@ class AndroidEventMonitor:
             print_with_timestamp("[manual] Finish input")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Android Operation Recorder")
+    parser.add_argument("-s", "--serial", help="Serial of device to record (adb -s)")
+    parser.add_argument("--long-session-window", type=int, default=None,
+                        help="Keep only this many recent steps in memory, older steps are spilled to disk")
+    parser.add_argument("--skip-redundant-captures", action="store_true",
+                        help="Skip annotated (processed) screenshots of steps whose transition was already "
+                             "recorded; screenshots and UI trees are still captured from the device")
+    parser.add_argument("--flush-interval", type=float, default=1.0,
+                        help="Seconds between group commits of step files to disk")
+    args = parser.parse_args()
+
     root = tk.Tk()
     gui = RecorderGUI(root)
-    monitor = AndroidEventMonitor()
+    monitor = AndroidEventMonitor(f"-s {args.serial}" if args.serial else "",
+                                  long_session_window=args.long_session_window,
+                                  skip_redundant_captures=args.skip_redundant_captures,
+                                  flush_interval=args.flush_interval)
     gui.set_monitor(monitor)
     
     try:
@@ -596,5 +850,13 @@ if __name__ == "__main__":
         root.mainloop()
     except KeyboardInterrupt:
         monitor.running = False
+        monitor.activity_tracker.stop()
     finally:
+        # Persist committed steps of an unfinished path
+        if monitor.writer:
+            try:
+                monitor.writer.close()
+            except OSError as e:
+                print(f"Error saving steps: {e}")
+        monitor.state_graph.close()
         root.destroy()
\ No newline at end of file
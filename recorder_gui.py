@@ -1,8 +1,13 @@
 import tkinter as tk
 from tkinter import ttk
 from PIL import Image, ImageTk
+import io
 import json
 import os
+import queue
+import zlib
+import threading
+from collections import OrderedDict
 from datetime import datetime
 import time
 
@@ -14,9 +19,16 @@ class RecorderGUI:
         # Set window size and position
         self.root.geometry("1000x1000")  # Adjust to larger size
         
-        # Add periodic update functionality
-        self.pending_screenshot = None
-        self.root.after(100, self.check_pending_updates)
+        # Updates are posted from any thread and applied on the Tk thread
+        self.events = queue.Queue()
+        self.thumbnail_size = (400, 400)
+        self.thumbnail_cache = OrderedDict()  # (path, crc32) -> PIL thumbnail
+        self.thumbnail_cache_size = 16
+        threading.Thread(target=self._process_events, daemon=True).start()
+        
+        # Operations waiting for a capture to finish run one at a time off the Tk thread
+        self.tasks = queue.Queue()
+        threading.Thread(target=self._process_tasks, daemon=True).start()
         
         # Create main frame
         self.main_frame = ttk.Frame(self.root, padding="20")  # Add inner padding
@@ -36,6 +48,10 @@ class RecorderGUI:
         self.step_label = ttk.Label(self.main_frame, text="Current Step: 0", font=('Arial', 12))  # Increase font size
         self.step_label.grid(row=1, column=0, columnspan=2, pady=10)
         
+        # Session metrics (step counts and resident memory)
+        self.metrics_label = ttk.Label(self.main_frame, text="")
+        self.metrics_label.grid(row=5, column=0, columnspan=2, pady=5)
+        
         # Last action information
         self.last_action_frame = ttk.LabelFrame(self.main_frame, text="Last Action", padding="10")
         self.last_action_frame.grid(row=2, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=10)
@@ -84,79 +100,174 @@ class RecorderGUI:
         self.monitor.gui = self
     
     def update_step_display(self, step_id):
-        """Update step display"""
-        self.step_label.config(text=f"Current Step: {step_id}")
+        """Update step display (thread-safe)"""
+        self.events.put(("step", step_id))
     
     def update_last_action(self, action_data):
-        """Update last action information"""
-        self.last_action_text.config(state='normal')
-        self.last_action_text.delete(1.0, tk.END)
-        self.last_action_text.insert(1.0, json.dumps(action_data, indent=2, ensure_ascii=False))
-        self.last_action_text.config(state='disabled')
+        """Update last action information (thread-safe)"""
+        text = json.dumps(action_data, indent=2, ensure_ascii=False)
         
-        # Set pending screenshot path
+        # Resolve screenshot path now, record directory may change before preview is decoded
+        screenshot = None
         if action_data and 'screen_shot' in action_data:
             if "screenshots" in action_data['screen_shot']:
-                self.pending_screenshot = os.path.join(
+                screenshot = os.path.join(
                     self.monitor.record_dir,
                     f"record_{self.monitor.record_timestamp}",
                     action_data['screen_shot']
                 )
             else:
-                self.pending_screenshot = os.path.join(
+                screenshot = os.path.join(
                     self.monitor.record_dir,
                     f"record_{self.monitor.record_timestamp}",
                     "screenshots",
                     action_data['screen_shot']
                 )
+        self.events.put(("action", text, screenshot))
 
-    def check_pending_updates(self):
-        """Periodically check for pending screenshot updates"""
-        if self.pending_screenshot:
-            print(self.pending_screenshot)
-            if os.path.exists(self.pending_screenshot):
+    def report_error(self, message, recording=False):
+        """Show error, re-enable target input unless the path is still recording (thread-safe)"""
+        self.events.put(("error", message, recording))
+
+    def post_step(self, action_data, step_id):
+        """Post recorded step from capture thread"""
+        self.update_last_action(action_data)
+        self.update_step_display(step_id)
+
+    def _process_events(self):
+        """Consume posted events, decode preview off the Tk thread and hand over once per burst"""
+        while True:
+            events = [self.events.get()]
+            # Coalesce everything queued during a burst into a single update
+            while True:
                 try:
-                    image = Image.open(self.pending_screenshot)
-                    # Adjust image size to fit display
-                    image.thumbnail((400, 400))
-                    photo = ImageTk.PhotoImage(image)
-                    self.screenshot_label.config(image=photo)
-                    self.screenshot_label.image = photo
-                    self.pending_screenshot = None
-                except Exception as e:
-                    print(f"Error loading image: {e}")
-        
-        # Continue periodic checking
-        self.root.after(100, self.check_pending_updates)
+                    events.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            
+            update = {}
+            for event in events:
+                if event[0] == "step":
+                    update["step"] = event[1]
+                elif event[0] == "action":
+                    update["text"] = event[1]
+                    if event[2]:
+                        update["screenshot"] = event[2]
+                elif event[0] == "clear":
+                    update = {"text": "", "step": 0, "clear_image": True, "controls": False, "clear_target": True}
+                elif event[0] == "error":
+                    update["text"] = event[1]
+                    update["controls"] = event[2]
+                    if not event[2]:
+                        update.update(step=0, clear_image=True)
+            
+            if "screenshot" in update:
+                update["thumbnail"] = self._load_thumbnail(update["screenshot"])
+            if "step" in update and self.monitor:
+                update["metrics"] = self.monitor.get_metrics()
+            
+            try:
+                self.root.after_idle(self._apply_update, update)
+            except RuntimeError:
+                # Tk main loop has exited
+                break
+
+    def _load_thumbnail(self, path):
+        """Decode and downscale screenshot, cached by path and content checksum"""
+        try:
+            # Screenshot may still be staged in memory by the artifact writer
+            data = self.monitor.read_artifact(path)
+        except OSError:
+            return None
+        key = (path, zlib.crc32(data))
+        
+        thumbnail = self.thumbnail_cache.get(key)
+        if thumbnail is not None:
+            self.thumbnail_cache.move_to_end(key)
+            return thumbnail
+        
+        try:
+            image = Image.open(io.BytesIO(data))
+            # Let decoder downscale where supported (JPEG), then reduce by integer factor
+            image.draft('RGB', self.thumbnail_size)
+            factor = min(image.width // self.thumbnail_size[0], image.height // self.thumbnail_size[1])
+            if factor > 1:
+                image = image.reduce(factor)
+            image.thumbnail(self.thumbnail_size)
+        except Exception as e:
+            print(f"Error loading image: {e}")
+            return None
+        
+        self.thumbnail_cache[key] = image
+        if len(self.thumbnail_cache) > self.thumbnail_cache_size:
+            self.thumbnail_cache.popitem(last=False)
+        return image
+
+    def _apply_update(self, update):
+        """Apply coalesced update on the Tk thread"""
+        if "step" in update:
+            self.step_label.config(text=f"Current Step: {update['step']}")
+        
+        if "metrics" in update:
+            metrics = update["metrics"]
+            text = (f"Steps: {metrics['step_count']} "
+                    f"(in memory: {metrics['resident_steps']}, on disk: {metrics['spilled_steps']})")
+            if metrics["rss_bytes"] is not None:
+                text += f"  |  Memory: {metrics['rss_bytes'] / (1024 * 1024):.1f} MB"
+            self.metrics_label.config(text=text)
+        
+        if "text" in update:
+            self.last_action_text.config(state='normal')
+            self.last_action_text.delete(1.0, tk.END)
+            self.last_action_text.insert(1.0, update["text"])
+            self.last_action_text.config(state='disabled')
+        
+        if update.get("clear_image"):
+            self.screenshot_label.config(image='')
+            self.screenshot_label.image = None
+        elif update.get("thumbnail") is not None:
+            photo = ImageTk.PhotoImage(update["thumbnail"])
+            self.screenshot_label.config(image=photo)
+            self.screenshot_label.image = photo
+        
+        if "controls" in update:
+            self._set_recording_controls(update["controls"])
+        if update.get("clear_target"):
+            self.target_entry.delete(0, tk.END)
+
+    def _process_tasks(self):
+        """Run submitted operations in order, results are posted as events"""
+        while True:
+            task = self.tasks.get()
+            try:
+                task()
+            except Exception as e:
+                print(f"Error in operation: {e}")
+
+    def _set_recording_controls(self, recording):
+        """Enable either target input or the operation buttons"""
+        target_state = 'disabled' if recording else 'normal'
+        operation_state = 'normal' if recording else 'disabled'
+        self.target_entry.config(state=target_state)
+        self.target_button.config(state=target_state)
+        self.delete_button.config(state=operation_state)
+        self.finish_button.config(state=operation_state)
+        self.finish_input_button.config(state=operation_state)
+        self.retake_button.config(state=operation_state)
 
     def delete_last_step(self):
         """Delete last action"""
-        if self.monitor and self.monitor.actions:
-            # Delete last action
-            last_action = self.monitor.actions.pop()
-            # Delete corresponding screenshot
-            screenshot_path = os.path.join(
-                self.monitor.record_dir,
-                f"record_{self.monitor.record_timestamp}",
-                "screenshots",
-                last_action['screen_shot']
-            )
-            try:
-                os.remove(screenshot_path)
-            except:
-                pass
-            
-            # Update step_id
-            self.monitor.step_id -= 1
-            # Save updated record
-            self.monitor._save_actions()
+        if self.monitor:
+            # Waits for a step being captured
+            self.tasks.put(self._delete_last_step)
+
+    def _delete_last_step(self):
+        # Only steps still resident in memory can be deleted
+        if self.monitor.actions.last():
+            last_action = self.monitor.delete_last_step()
             
             # Update display
-            if self.monitor.actions:
-                self.update_last_action(self.monitor.actions[-1])
-            else:
-                self.update_last_action(None)
-            self.update_step_display(self.monitor.step_id)
+            self.post_step(last_action, self.monitor.step_id)
     
     def set_target(self):
         """Set path target"""
@@ -164,60 +275,31 @@ class RecorderGUI:
         if target:
             # Set target and enable buttons
             self.monitor.set_path_target(target)
-            self.target_entry.config(state='disabled')
-            self.target_button.config(state='disabled')
-            self.delete_button.config(state='normal')
-            self.finish_button.config(state='normal')
-            self.finish_input_button.config(state='normal')
-            self.retake_button.config(state='normal')
+            self._set_recording_controls(True)
     
     def finish_current_path(self):
         """End current path recording"""
         if self.monitor:
-            # Disable recording
-            self.monitor.recording_enabled = False
-            
-            # Save current record
-            self.monitor._save_actions()
-            
-            # Create new recording session
-            self.monitor.record_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.monitor.screenshots_dir = os.path.join(
-                self.monitor.record_dir,
-                f"record_{self.monitor.record_timestamp}",
-                "screenshots"
-            )
-            os.makedirs(self.monitor.screenshots_dir, exist_ok=True)
-            
-            # Reset recording state
-            self.monitor.actions = []
-            self.monitor.step_id = 0
-            
-            # Update display
-            self.pending_screenshot = None  # Clear pending screenshot
-            self.update_last_action(None)
-            self.update_step_display(0)
-            self.screenshot_label.config(image='')
-            
-            # Re-enable target input
-            self.target_entry.config(state='normal')
-            self.target_button.config(state='normal')
-            self.target_entry.delete(0, tk.END)
-            
-            # Disable operation buttons
-            self.delete_button.config(state='disabled')
-            self.finish_button.config(state='disabled')
-            self.finish_input_button.config(state='disabled')
-            self.retake_button.config(state='disabled')
+            # No input until the record is saved, which waits for a step being captured
+            self._set_recording_controls(False)
+            self.target_entry.config(state='disabled')
+            self.target_button.config(state='disabled')
+            self.tasks.put(self._finish_current_path)
+
+    def _finish_current_path(self):
+        # Disable recording, save complete record and reset steps
+        try:
+            self.monitor.finish_current_path()
+        except OSError as e:
+            self.report_error(f"Could not finish path, try again: {e}", recording=True)
+            return
+        
+        # Clear display, re-enable target input and disable operation buttons
+        self.events.put(("clear",))
 
     def update_initial_screenshot(self, image_path):
-        """Update initial page screenshot"""
-        self.pending_screenshot = image_path
-        # Clear last action information
-        self.last_action_text.config(state='normal')
-        self.last_action_text.delete(1.0, tk.END)
-        self.last_action_text.insert(1.0, "Initial Page")
-        self.last_action_text.config(state='disabled')
+        """Update initial page screenshot (thread-safe)"""
+        self.events.put(("action", "Initial Page", image_path))
 
     def finish_input(self):
         """Manually finish current input and record"""
@@ -226,19 +308,31 @@ class RecorderGUI:
 
     def retake_screenshot(self):
         """Retake screenshot for current step"""
-        if self.monitor and self.monitor.actions:
-            current_step = self.monitor.actions[-1]
+        if self.monitor:
+            self.tasks.put(self._retake_screenshot)
+
+    def _retake_screenshot(self):
+        # Finishing the path or a new step must not interleave with the retake
+        with self.monitor.step_lock:
+            self._retake_last_step()
+
+    def _retake_last_step(self):
+        if self.monitor.actions.last():
+            current_step = self.monitor.actions.last()
             step_id = current_step['step_id']
             
             # Retake screenshot
             screenshot_success = self.monitor.take_screenshot(os.path.join(self.monitor.screenshots_dir, f"step_{step_id}"))
             
             if screenshot_success:
+                # Screenshot of a redundant step may have been dropped
+                current_step.setdefault("screen_shot", f"step_{step_id}.png")
+                
                 # Process screenshot if needed (for non-initial steps)
                 if step_id > 0:
                     # Get previous screenshot
                     prev_screenshot = os.path.join(self.monitor.screenshots_dir, f"step_{step_id-1}.png")
-                    if os.path.exists(prev_screenshot):
+                    if self.monitor.artifact_exists(prev_screenshot):
                         # Generate processed screenshot based on previous screenshot
                         processed_path = self.monitor.process_screenshot(prev_screenshot, current_step)
                         if processed_path:
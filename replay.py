@@ -0,0 +1,361 @@
+import asyncio
+import argparse
+import os
+from datetime import datetime
+from device_profile import PROFILE_CACHE_DIR, load_device_profile, load_device_profiles
+from step_store import read_record
+from touch_tracker import read_trajectories
+
+# Linux key names recorded by getevent that differ from Android KEYCODE names
+KEYCODE_MAP = {
+    'KEY_BACK': 'KEYCODE_BACK',
+    'KEY_HOME': 'KEYCODE_HOME',
+    'KEY_APPSELECT': 'KEYCODE_APP_SWITCH',
+    'KEY_ENTER': 'KEYCODE_ENTER',
+    'KEY_BACKSPACE': 'KEYCODE_DEL',
+    'KEY_DELETE': 'KEYCODE_FORWARD_DEL',
+    'KEY_DOT': 'KEYCODE_PERIOD',
+    'KEY_EQUAL': 'KEYCODE_EQUALS',
+    'KEY_LEFTBRACE': 'KEYCODE_LEFT_BRACKET',
+    'KEY_RIGHTBRACE': 'KEYCODE_RIGHT_BRACKET',
+    'KEY_LEFTSHIFT': 'KEYCODE_SHIFT_LEFT',
+    'KEY_RIGHTSHIFT': 'KEYCODE_SHIFT_RIGHT',
+    'KEY_LEFTALT': 'KEYCODE_ALT_LEFT',
+    'KEY_RIGHTALT': 'KEYCODE_ALT_RIGHT',
+    'KEY_LEFTCTRL': 'KEYCODE_CTRL_LEFT',
+    'KEY_RIGHTCTRL': 'KEYCODE_CTRL_RIGHT',
+    'KEY_UP': 'KEYCODE_DPAD_UP',
+    'KEY_DOWN': 'KEYCODE_DPAD_DOWN',
+    'KEY_LEFT': 'KEYCODE_DPAD_LEFT',
+    'KEY_RIGHT': 'KEYCODE_DPAD_RIGHT',
+    'KEY_VOLUMEUP': 'KEYCODE_VOLUME_UP',
+    'KEY_VOLUMEDOWN': 'KEYCODE_VOLUME_DOWN',
+    'KEY_ESC': 'KEYCODE_ESCAPE',
+}
+
+# Input event codes used for sendevent streams
+EV_SYN, EV_KEY, EV_ABS = 0, 1, 3
+SYN_REPORT = 0
+BTN_TOUCH = 0x14a
+ABS_MT_SLOT = 0x2f
+ABS_MT_POSITION_X = 0x35
+ABS_MT_POSITION_Y = 0x36
+ABS_MT_TRACKING_ID = 0x39
+ABS_MT_PRESSURE = 0x3a
+
+MAX_SCRIPT_LENGTH = 32000  # Keep each `adb shell` argument well below command line limits
+
+
+def key_to_keycode(key):
+    """Convert getevent key name (KEY_A) to Android keycode name (KEYCODE_A)"""
+    return KEYCODE_MAP.get(key, "KEYCODE_" + key[len("KEY_"):])
+
+
+def step_to_input_commands(step, scale_x=1.0, scale_y=1.0):
+    """Translate recorded step to `adb shell input` commands, None if not expressible
+
+    Coordinates are multiplied by the scale from recorded to target screen pixels.
+    """
+    action_type = step["action_type"]
+    detail = step["action_detail"]
+
+    def point(x_key, y_key):
+        return f"{round(detail[x_key] * scale_x)} {round(detail[y_key] * scale_y)}"
+
+    if action_type == "click":
+        return [f"input tap {point('x', 'y')}"]
+    if action_type == "press":
+        duration = int(detail.get("duration", 1) * 1000)
+        return [f"input swipe {point('x', 'y')} {point('x', 'y')} {duration}"]
+    if action_type == "swipe":
+        duration = int(detail.get("duration", 0.3) * 1000)
+        return [f"input swipe {point('start_x', 'start_y')} {point('end_x', 'end_y')} {duration}"]
+    if action_type == "input":
+        keys = [key.strip() for key in detail["text"].split(",") if key.strip()]
+        return ["input keyevent " + " ".join(key_to_keycode(key) for key in keys)]
+    if action_type == "special_event":
+        return [f"input keyevent {key_to_keycode(detail['event'])}"]
+    return None
+
+
+def trajectories_to_sendevent_scripts(trajectories, profile, screen_size=None):
+    """Translate trajectories to shell scripts writing raw events with sendevent
+
+    Trajectories are in pixels of the recording screen, `screen_size` as
+    (width, height), which defaults to the screen of the target device.
+    Recorded slots are renumbered from 0 in order of first use, so they fit
+    the slots of the target device.
+    """
+    device = profile.touch_device
+    screen_width, screen_height = screen_size or (profile.screen_width, profile.screen_height)
+    scale_x = profile.max_x / screen_width
+    scale_y = profile.max_y / screen_height
+
+    slots = {}
+    for trajectory in sorted(trajectories, key=lambda trajectory: trajectory.t[0]):
+        slots.setdefault(trajectory.slot, len(slots))
+    if profile.max_slot is not None and len(slots) > profile.max_slot + 1:
+        raise ValueError(f"Gesture uses {len(slots)} touch slots, device supports {profile.max_slot + 1}")
+
+    # Merge samples of all fingers into frames ordered by time
+    samples = []
+    for trajectory in trajectories:
+        last = len(trajectory) - 1
+        for i in range(len(trajectory)):
+            samples.append((trajectory.t[i], trajectory, i, i == 0, i == last))
+    samples.sort(key=lambda sample: sample[0])
+
+    lines = [f"sendevent {device} {EV_KEY} {BTN_TOUCH} 1"]
+    previous_t = None
+    index = 0
+    while index < len(samples):
+        t = samples[index][0]
+        if previous_t is not None and t - previous_t >= 0.005:
+            lines.append(f"sleep {t - previous_t:.3f}")
+        previous_t = t
+
+        released = []
+        while index < len(samples) and samples[index][0] == t:
+            _, trajectory, i, is_first, is_last = samples[index]
+            lines.append(f"sendevent {device} {EV_ABS} {ABS_MT_SLOT} {slots[trajectory.slot]}")
+            if is_first:
+                lines.append(f"sendevent {device} {EV_ABS} {ABS_MT_TRACKING_ID} {trajectory.tracking_id}")
+            lines.append(f"sendevent {device} {EV_ABS} {ABS_MT_POSITION_X} {int(trajectory.x[i] * scale_x)}")
+            lines.append(f"sendevent {device} {EV_ABS} {ABS_MT_POSITION_Y} {int(trajectory.y[i] * scale_y)}")
+            if profile.max_pressure:
+                lines.append(f"sendevent {device} {EV_ABS} {ABS_MT_PRESSURE} {int(trajectory.pressure[i])}")
+            if is_last:
+                released.append(slots[trajectory.slot])
+            index += 1
+        lines.append(f"sendevent {device} {EV_SYN} {SYN_REPORT} 0")
+
+        # Lift fingers after their last sample
+        for slot in released:
+            lines.append(f"sendevent {device} {EV_ABS} {ABS_MT_SLOT} {slot}")
+            lines.append(f"sendevent {device} {EV_ABS} {ABS_MT_TRACKING_ID} -1")
+        if released:
+            lines.append(f"sendevent {device} {EV_SYN} {SYN_REPORT} 0")
+
+    lines.append(f"sendevent {device} {EV_KEY} {BTN_TOUCH} 0")
+    lines.append(f"sendevent {device} {EV_SYN} {SYN_REPORT} 0")
+
+    # Batch lines into as few shell invocations as possible
+    scripts = []
+    current = []
+    length = 0
+    for line in lines:
+        if current and length + len(line) + 2 > MAX_SCRIPT_LENGTH:
+            scripts.append("; ".join(current))
+            current = []
+            length = 0
+        current.append(line)
+        length += len(line) + 2
+    if current:
+        scripts.append("; ".join(current))
+    return scripts
+
+
+class DeviceReplayer:
+    """Replay recorded sessions on one device"""
+
+    def __init__(self, serial, adb="adb", settle_delay=1.0, wait_for_settle=False,
+                 settle_timeout=10.0, capture=False, use_sendevent=False, output_dir="replays",
+                 profile_cache_dir=PROFILE_CACHE_DIR):
+        self.serial = serial
+        self.adb = adb
+        self.settle_delay = settle_delay  # Fixed wait after each step
+        self.wait_for_settle = wait_for_settle  # Additionally wait until UI hierarchy stops changing
+        self.settle_timeout = settle_timeout
+        self.capture = capture
+        self.use_sendevent = use_sendevent  # Replay recorded trajectories instead of `input swipe`
+        self.output_dir = output_dir
+        self.profile_cache_dir = profile_cache_dir
+        self.profile = None
+
+    async def _adb(self, *args, check=True):
+        """Run adb command for this device and return raw output"""
+        process = await asyncio.create_subprocess_exec(
+            self.adb, "-s", self.serial, *args,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if check and process.returncode != 0:
+            raise RuntimeError(f"adb {' '.join(args)} failed: {stderr.decode(errors='replace').strip()}")
+        return stdout
+
+    async def shell(self, command):
+        return await self._adb("shell", command)
+
+    async def _get_profile(self):
+        """Device profile is only needed for sendevent streams"""
+        if self.profile is None:
+            self.profile = await asyncio.to_thread(load_device_profile, f"-s {self.serial}",
+                                                   self.profile_cache_dir, self.adb)
+        return self.profile
+
+    async def get_ui_hierarchy(self):
+        output = await self._adb(
+            "exec-out",
+            "uiautomator dump /sdcard/window_dump.xml >/dev/null && cat /sdcard/window_dump.xml"
+        )
+        return output.decode('utf-8', errors='replace')
+
+    async def take_screenshot(self):
+        return await self._adb("exec-out", "screencap -p")
+
+    async def wait_until_settled(self):
+        """Sleep settle delay, optionally poll UI hierarchy until two dumps match"""
+        await asyncio.sleep(self.settle_delay)
+        if not self.wait_for_settle:
+            return None
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.settle_timeout
+        previous = await self.get_ui_hierarchy()
+        while loop.time() < deadline:
+            await asyncio.sleep(0.3)
+            current = await self.get_ui_hierarchy()
+            if current == previous:
+                break
+            previous = current
+        return previous
+
+    async def _capture_step(self, replay_dir, step_id, ui_tree=None):
+        """Save screenshot and UI hierarchy of current screen"""
+        screenshot = await self.take_screenshot()
+        with open(os.path.join(replay_dir, "screenshots", f"step_{step_id}.png"), 'wb') as f:
+            f.write(screenshot)
+
+        if ui_tree is None:
+            ui_tree = await self.get_ui_hierarchy()
+        with open(os.path.join(replay_dir, "ui_trees", f"step_{step_id}_ui.xml"), 'w', encoding='utf-8') as f:
+            f.write(ui_tree)
+
+    async def _get_scale(self, screen_size):
+        """Scale from recorded to this device's screen pixels, 1 if the record has no screen size"""
+        if not screen_size:
+            return 1.0, 1.0
+        profile = await self._get_profile()
+        return profile.screen_width / screen_size[0], profile.screen_height / screen_size[1]
+
+    async def _step_commands(self, record_path, step, screen_size=None):
+        """Shell commands replaying one step recorded on a screen of `screen_size`"""
+        trajectory_file = step.get("trajectory")
+        needs_trajectory = step["action_type"] == "multi_touch" or (
+            self.use_sendevent and step["action_type"] in ("click", "press", "swipe"))
+        if trajectory_file and needs_trajectory:
+            profile = await self._get_profile()
+            if profile.touch_device:
+                trajectories = read_trajectories(os.path.join(record_path, "trajectories", trajectory_file))
+                return trajectories_to_sendevent_scripts(trajectories, profile, screen_size)
+
+        commands = step_to_input_commands(step, *await self._get_scale(screen_size))
+        if commands is None:
+            raise ValueError(f"Cannot replay {step['action_type']} step without trajectory")
+        return commands
+
+    async def replay(self, record_path):
+        """Replay one recorded session, return result summary"""
+        record_name = os.path.basename(os.path.normpath(record_path))
+        result = {"record": record_path, "device": self.serial, "steps": 0, "errors": []}
+
+        # Failures outside a single step end this record only, step_id None marks them
+        try:
+            # Validate record before anything is created or run on the device
+            record_data, steps = read_record(record_path)
+            size = record_data.get("screen_size") or {}
+            screen_size = (size["width"], size["height"]) if size.get("width") and size.get("height") else None
+
+            replay_dir = None
+            if self.capture:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                safe_serial = self.serial.replace(":", "_")
+                replay_dir = os.path.join(self.output_dir, f"replay_{record_name}_{safe_serial}_{timestamp}")
+                os.makedirs(os.path.join(replay_dir, "screenshots"), exist_ok=True)
+                os.makedirs(os.path.join(replay_dir, "ui_trees"), exist_ok=True)
+                result["output_dir"] = replay_dir
+                await self._capture_step(replay_dir, 0)
+
+            for step in steps:
+                try:
+                    for command in await self._step_commands(record_path, step, screen_size):
+                        await self.shell(command)
+                    ui_tree = await self.wait_until_settled()
+                    if replay_dir:
+                        await self._capture_step(replay_dir, step["step_id"], ui_tree)
+                    result["steps"] += 1
+                except Exception as e:
+                    print(f"[{self.serial}] Error replaying step {step.get('step_id')} of {record_name}: {e}")
+                    result["errors"].append({"step_id": step.get("step_id"), "error": str(e)})
+        except Exception as e:
+            print(f"[{self.serial}] Error replaying {record_name}: {e}")
+            result["errors"].append({"step_id": None, "error": str(e)})
+        return result
+
+
+class ReplayScheduler:
+    """Replay many sessions across several devices concurrently
+
+    Every device runs one session at a time, sessions are taken from a shared
+    queue so faster devices replay more of them.
+    """
+
+    def __init__(self, serials, **replayer_options):
+        self.replayers = [DeviceReplayer(serial, **replayer_options) for serial in serials]
+
+    async def _load_profiles(self):
+        """Probe all devices in parallel up front, failed ones are retried on first use"""
+        if not self.replayers:
+            return
+        options = self.replayers[0]
+        device_ids = [f"-s {replayer.serial}" for replayer in self.replayers]
+        profiles = await asyncio.to_thread(load_device_profiles, device_ids,
+                                           options.profile_cache_dir, options.adb)
+        for replayer, device_id in zip(self.replayers, device_ids):
+            replayer.profile = profiles.get(device_id)
+
+    async def run(self, record_paths):
+        await self._load_profiles()
+
+        queue = asyncio.Queue()
+        for record_path in record_paths:
+            queue.put_nowait(record_path)
+
+        results = []
+
+        async def worker(replayer):
+            while True:
+                try:
+                    record_path = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                print(f"[{replayer.serial}] Replaying {record_path}")
+                results.append(await replayer.replay(record_path))
+
+        await asyncio.gather(*(worker(replayer) for replayer in self.replayers))
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded paths on Android devices")
+    parser.add_argument("records", nargs="+", help="Record directories containing record.json")
+    parser.add_argument("-s", "--serial", action="append", required=True,
+                        help="Device serial, repeat to replay on several devices")
+    parser.add_argument("--adb", default="adb", help="adb executable")
+    parser.add_argument("--settle-delay", type=float, default=1.0, help="Seconds to wait after each step")
+    parser.add_argument("--wait-for-settle", action="store_true",
+                        help="Wait until UI hierarchy stops changing after each step")
+    parser.add_argument("--capture", action="store_true", help="Capture screenshots and UI trees while replaying")
+    parser.add_argument("--sendevent", action="store_true",
+                        help="Replay recorded touch trajectories with sendevent instead of `input`")
+    parser.add_argument("--output-dir", default="replays", help="Directory for captured replays")
+    args = parser.parse_args()
+
+    scheduler = ReplayScheduler(
+        args.serial, adb=args.adb, settle_delay=args.settle_delay,
+        wait_for_settle=args.wait_for_settle, capture=args.capture,
+        use_sendevent=args.sendevent, output_dir=args.output_dir
+    )
+    for result in asyncio.run(scheduler.run(args.records)):
+        print(f"{result['record']} on {result['device']}: {result['steps']} steps replayed, "
+              f"{len(result['errors'])} errors")
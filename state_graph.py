@@ -0,0 +1,206 @@
+import contextlib
+import hashlib
+import os
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+
+# Attributes describing screen structure; text, content-desc, bounds and
+# focus/selection state change without the screen changing and are ignored
+STRUCTURAL_ATTRIBUTES = ('class', 'resource-id', 'package', 'clickable',
+                         'long-clickable', 'scrollable', 'checkable', 'password')
+
+
+class UIFingerprinter:
+    """Incremental structural hash of a uiautomator hierarchy
+
+    XML can be fed in chunks as it is read. Each node hash covers its
+    structural attributes and the set of distinct child hashes, so repeated
+    list items and their count or order do not change the fingerprint.
+    """
+
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._children = [set()]
+
+    def feed(self, data):
+        self._parser.feed(data)
+        self._process_events()
+
+    def _process_events(self):
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                self._children.append(set())
+                continue
+
+            children = self._children.pop()
+            digest = hashlib.blake2b(digest_size=8)
+            digest.update(element.tag.encode())
+            for name in STRUCTURAL_ATTRIBUTES:
+                digest.update(b'\0' + element.get(name, '').encode())
+            for child in sorted(children):
+                digest.update(child)
+            self._children[-1].add(digest.digest())
+            # Drop parsed subtree, only hashes are kept
+            element.clear()
+
+    def finish(self):
+        """Return hex fingerprint of the whole hierarchy"""
+        self._parser.close()
+        self._process_events()
+        digest = hashlib.blake2b(digest_size=8)
+        for child in sorted(self._children[0]):
+            digest.update(child)
+        return digest.hexdigest()
+
+
+def ui_fingerprint(xml_content, chunk_size=65536):
+    """Structural fingerprint of UI hierarchy XML, None if it cannot be parsed"""
+    fingerprinter = UIFingerprinter()
+    try:
+        for start in range(0, len(xml_content), chunk_size):
+            fingerprinter.feed(xml_content[start:start + chunk_size])
+        return fingerprinter.finish()
+    except ET.ParseError:
+        return None
+
+
+def action_key(step_data):
+    """Coarse action identity used for transitions, tolerant to small position noise"""
+    action_type = step_data["action_type"]
+    detail = step_data["action_detail"]
+
+    if action_type in ("click", "press"):
+        target = step_data.get("operated_bounds") or f"{detail['x'] // 50},{detail['y'] // 50}"
+        return f"{action_type}:{target}"
+    if action_type == "swipe":
+        dx = detail["end_x"] - detail["start_x"]
+        dy = detail["end_y"] - detail["start_y"]
+        if abs(dx) > abs(dy):
+            direction = "right" if dx > 0 else "left"
+        else:
+            direction = "down" if dy > 0 else "up"
+        return f"swipe:{direction}"
+    if action_type == "input":
+        return f"input:{detail['text']}"
+    if action_type == "special_event":
+        return f"special_event:{detail['event']}"
+    if action_type == "multi_touch":
+        return f"multi_touch:{detail['gesture']}"
+    return action_type
+
+
+class StateGraph:
+    """On-disk graph of UI states and (state, action) -> next state transitions
+
+    States and transitions are kept in an SQLite database shared by all
+    sessions, so looking up a screen or transition is an index lookup that
+    does not depend on the number of recorded sessions. SQLite locking lets
+    recorders of several devices update the graph at the same time.
+    """
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        # Transactions are managed explicitly, see _transaction()
+        self._conn = sqlite3.connect(os.path.join(path, "state_graph.sqlite3"), timeout=30,
+                                     isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, commits are not fsynced, only checkpoints; the graph stays
+        # consistent after a crash, only the latest updates may be lost
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS states (
+            state TEXT PRIMARY KEY,
+            first_seen TEXT,
+            activity TEXT,
+            visits INTEGER NOT NULL
+        )""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS transitions (
+            state TEXT NOT NULL,
+            action TEXT NOT NULL,
+            next_state TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (state, action, next_state)
+        )""")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Write transaction, takes the database write lock up front so
+        read-modify-write is atomic across processes"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _query(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def has_state(self, state):
+        return bool(self._query("SELECT 1 FROM states WHERE state = ?", (state,)))
+
+    def get_state(self, state):
+        """State info (first seen location, activity, visit count), None if unknown
+
+        first_seen is None when the step it pointed to was deleted.
+        """
+        rows = self._query("SELECT first_seen, activity, visits FROM states WHERE state = ?", (state,))
+        if not rows:
+            return None
+        first_seen, activity, visits = rows[0]
+        return {"first_seen": first_seen, "activity": activity, "visits": visits}
+
+    def add_state(self, state, location, activity=None):
+        """Record visit of state, return True if state was not seen before"""
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE states SET visits = visits + 1, first_seen = COALESCE(first_seen, ?) WHERE state = ?",
+                (location, state)).rowcount
+            if updated:
+                return False
+            conn.execute("INSERT INTO states VALUES (?, ?, ?, 1)", (state, location, activity))
+            return True
+
+    def remove_state(self, state, location):
+        """Undo one add_state, e.g. when the step at `location` is deleted"""
+        with self._transaction() as conn:
+            # Deleted step can no longer be the first occurrence, next visit takes its place
+            conn.execute("UPDATE states SET visits = visits - 1, first_seen = NULLIF(first_seen, ?) "
+                         "WHERE state = ?", (location, state))
+            conn.execute("DELETE FROM states WHERE state = ? AND visits <= 0", (state,))
+
+    def next_states(self, state, action):
+        """Observed next states of (state, action) as {state: count}"""
+        rows = self._query("SELECT next_state, count FROM transitions WHERE state = ? AND action = ?",
+                           (state, action))
+        return dict(rows)
+
+    def has_transition(self, state, action, next_state=None):
+        if next_state:
+            return bool(self._query(
+                "SELECT 1 FROM transitions WHERE state = ? AND action = ? AND next_state = ?",
+                (state, action, next_state)))
+        return bool(self.next_states(state, action))
+
+    def add_transition(self, state, action, next_state):
+        with self._transaction() as conn:
+            conn.execute("""INSERT INTO transitions VALUES (?, ?, ?, 1)
+                            ON CONFLICT (state, action, next_state) DO UPDATE SET count = count + 1""",
+                         (state, action, next_state))
+
+    def remove_transition(self, state, action, next_state):
+        """Undo one add_transition, e.g. when a step is deleted"""
+        key = (state, action, next_state)
+        with self._transaction() as conn:
+            conn.execute("UPDATE transitions SET count = count - 1 "
+                         "WHERE state = ? AND action = ? AND next_state = ?", key)
+            conn.execute("DELETE FROM transitions "
+                         "WHERE state = ? AND action = ? AND next_state = ? AND count <= 0", key)
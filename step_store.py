@@ -0,0 +1,163 @@
+import json
+import os
+import textwrap
+from itertools import chain, islice
+from artifact_writer import atomic_open
+
+SPILL_FILENAME = "steps.jsonl"
+
+
+def get_resident_memory():
+    """Resident memory of current process in bytes, None if unavailable"""
+    try:
+        # Linux: second field is resident pages
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except Exception:
+        return None
+
+
+class StepStore:
+    """Step list of one recording, optionally keeping only recent steps in memory
+
+    With a window, steps older than the last `window` steps are appended to
+    steps.jsonl in the record directory and dropped from memory. Only resident
+    steps can be deleted or edited. Spilled lines are only flushed to the OS,
+    the caller has the spill file fsynced before a record referencing its
+    steps is published, so it never falls behind record.json.
+    """
+
+    def __init__(self, record_path=None, window=None):
+        self.record_path = record_path
+        self.window = window  # None keeps all steps in memory
+        self.recent = []
+        self.spilled_count = 0
+        self.last_spilled = None  # Newest spilled step, kept as predecessor of the resident ones
+        self._spill_file = None
+
+    @property
+    def spill_path(self):
+        return os.path.join(self.record_path, SPILL_FILENAME)
+
+    def __len__(self):
+        return self.spilled_count + len(self.recent)
+
+    def __iter__(self):
+        """Iterate all steps, spilled steps are streamed from disk"""
+        if self.spilled_count:
+            self._spill_file.flush()
+            yield from read_spilled_steps(self.record_path, self.spilled_count)
+        yield from list(self.recent)
+
+    def append(self, step_data):
+        self.recent.append(step_data)
+        if self.window is not None and self.record_path:
+            while len(self.recent) > self.window:
+                self._spill(self.recent.pop(0))
+
+    def last(self):
+        """Last resident step, None if no editable step is left"""
+        return self.recent[-1] if self.recent else None
+
+    def last_recorded(self):
+        """Last step including spilled ones, None if there is none"""
+        return self.recent[-1] if self.recent else self.last_spilled
+
+    def pop(self):
+        """Remove and return last resident step"""
+        return self.recent.pop() if self.recent else None
+
+    def _spill(self, step_data):
+        if self._spill_file is None:
+            self._spill_file = open(self.spill_path, 'a', encoding='utf-8')
+        self._spill_file.write(json.dumps(step_data, ensure_ascii=False) + "\n")
+        self._spill_file.flush()
+        self.spilled_count += 1
+        self.last_spilled = step_data
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def finish(self, filename, header):
+        """Atomically write complete record.json and drop the spill file"""
+        with atomic_open(filename) as f:
+            self.write_record(f, header, final=True)
+        self.close()
+        if self.spilled_count:
+            os.remove(self.spill_path)
+            self.recent = []
+            self.spilled_count = 0
+            self.last_spilled = None
+
+    def get_metrics(self):
+        """Step counts and resident memory of the process"""
+        return {
+            "step_count": len(self),
+            "resident_steps": len(self.recent),
+            "spilled_steps": self.spilled_count,
+            "rss_bytes": get_resident_memory()
+        }
+
+    def write_record(self, f, header, final=False):
+        """Write record.json content to text stream
+
+        Without spilled steps, or when `final` is set, all steps are written,
+        streaming spilled steps so memory stays flat. Otherwise only resident
+        steps are written together with a reference to the spill file.
+        """
+        if self.spilled_count and not final:
+            record_data = dict(header)
+            record_data["spilled_steps_file"] = SPILL_FILENAME
+            record_data["spilled_step_count"] = self.spilled_count
+            record_data["steps"] = self.recent
+            json.dump(record_data, f, indent=4, ensure_ascii=False)
+            return
+
+        record_data = dict(header)
+        record_data["steps"] = []
+        text = json.dumps(record_data, indent=4, ensure_ascii=False)
+        prefix, suffix = text.rsplit("[]", 1)
+        f.write(prefix + "[")
+        for i, step_data in enumerate(self):
+            step_text = json.dumps(step_data, indent=4, ensure_ascii=False)
+            f.write(("," if i else "") + "\n" + textwrap.indent(step_text, " " * 8))
+        f.write(("\n    ]" if len(self) else "]") + suffix)
+
+
+def read_spilled_steps(record_path, count=None):
+    """Stream first `count` spilled steps of a record directory
+
+    The spill file can run ahead of record.json after a crash, possibly ending
+    in a torn line, so readers limit it to the count referenced by the record
+    and stop at an unterminated last line.
+    """
+    path = os.path.join(record_path, SPILL_FILENAME)
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = (line for line in f if line.strip())
+        for line in islice(lines, count):
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
+
+
+def read_record(record_path):
+    """Load record.json, return (record data without steps, iterator over all steps)
+
+    record.json is read right away, so a missing or invalid record raises here
+    rather than on first iteration. Spilled steps are streamed.
+    """
+    with open(os.path.join(record_path, "record.json"), 'r', encoding='utf-8') as f:
+        record_data = json.load(f)
+    steps = record_data.pop("steps", [])
+    if record_data.get("spilled_steps_file"):
+        return record_data, chain(read_spilled_steps(record_path, record_data.get("spilled_step_count")), steps)
+    return record_data, iter(steps)
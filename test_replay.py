@@ -0,0 +1,251 @@
+import asyncio
+import json
+import os
+import stat
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+from device_profile import DeviceProfile
+from replay import DeviceReplayer, ReplayScheduler, step_to_input_commands, trajectories_to_sendevent_scripts
+from touch_tracker import Trajectory, pack_trajectories
+
+# Touch screen with raw range twice the default screen size
+GETEVENT_OUTPUT = """add device 1: /dev/input/event2
+  name:     "fake_touchscreen"
+  events:
+    ABS (0003): ABS_MT_SLOT           : value 0, min 0, max 9, fuzz 0, flat 0, resolution 0
+                ABS_MT_POSITION_X     : value 0, min 0, max 2000, fuzz 0, flat 0, resolution 0
+                ABS_MT_POSITION_Y     : value 0, min 0, max 4000, fuzz 0, flat 0, resolution 0
+                ABS_MT_TRACKING_ID    : value 0, min 0, max 65535, fuzz 0, flat 0, resolution 0
+                ABS_MT_PRESSURE       : value 0, min 0, max 255, fuzz 0, flat 0, resolution 0
+"""
+
+# Logs every invocation as JSON line, answers profile probes and captures with fixed content
+FAKE_ADB = textwrap.dedent("""\
+    #!{python}
+    import json, os, sys, time
+    start = time.time()
+    args = sys.argv[1:]
+    serial = None
+    if args[:1] == ["-s"]:
+        serial, args = args[1], args[2:]
+    command = " ".join(args)
+    size = os.environ.get("FAKE_ADB_SIZE", "1000x2000")
+    time.sleep(float(os.environ.get("FAKE_ADB_DELAY", "0")))
+    if command == "get-serialno":
+        print(serial)
+    elif "getprop ro.build.fingerprint" in command:
+        print("fake/build:1\\nPhysical size: " + size + "\\nboot-1")
+    elif command == "shell wm size":
+        print("Physical size: " + size)
+    elif command == "shell getevent -lp":
+        sys.stdout.write({getevent!r})
+    elif command == "exec-out echo ok":
+        print("ok")
+    elif command == "exec-out screencap -p":
+        sys.stdout.buffer.write(b"\\x89PNG fake")
+    elif args[:1] == ["exec-out"] and "uiautomator" in command:
+        sys.stdout.write("<hierarchy/>")
+    with open(os.environ["FAKE_ADB_LOG"], "a") as f:
+        f.write(json.dumps({{"serial": serial, "args": args, "start": start, "end": time.time()}}) + "\\n")
+""")
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+
+        self.adb = os.path.join(self.temp_dir, "adb")
+        with open(self.adb, 'w') as f:
+            f.write(FAKE_ADB.format(python=sys.executable, getevent=GETEVENT_OUTPUT))
+        os.chmod(self.adb, os.stat(self.adb).st_mode | stat.S_IXUSR)
+
+        self.log_path = os.path.join(self.temp_dir, "adb.log")
+        environ = mock.patch.dict(os.environ, {"FAKE_ADB_LOG": self.log_path, "FAKE_ADB_DELAY": "0"})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def write_record(self, name, steps, trajectories=None, screen_size=None):
+        record_path = os.path.join(self.temp_dir, name)
+        os.makedirs(os.path.join(record_path, "trajectories"))
+        record_data = {"target": name, "steps": steps}
+        if screen_size:
+            record_data["screen_size"] = {"width": screen_size[0], "height": screen_size[1]}
+        with open(os.path.join(record_path, "record.json"), 'w', encoding='utf-8') as f:
+            json.dump(record_data, f)
+        for filename, data in (trajectories or {}).items():
+            with open(os.path.join(record_path, "trajectories", filename), 'wb') as f:
+                f.write(data)
+        return record_path
+
+    def read_log(self):
+        if not os.path.exists(self.log_path):
+            return []
+        with open(self.log_path, 'r') as f:
+            return [json.loads(line) for line in f]
+
+    def shell_commands(self, serial=None):
+        """Replayed input and sendevent commands, without profile probes"""
+        return [entry["args"][1] for entry in self.read_log()
+                if entry["args"][0] == "shell" and entry["args"][1].startswith(("input ", "sendevent "))
+                and serial in (None, entry["serial"])]
+
+    def test_step_to_input_commands(self):
+        self.assertEqual(step_to_input_commands(
+            {"action_type": "click", "action_detail": {"x": 10, "y": 20}}), ["input tap 10 20"])
+        self.assertEqual(step_to_input_commands(
+            {"action_type": "input", "action_detail": {"text": "KEY_H, KEY_I, KEY_BACKSPACE"}}),
+            ["input keyevent KEYCODE_H KEYCODE_I KEYCODE_DEL"])
+        self.assertIsNone(step_to_input_commands(
+            {"action_type": "multi_touch", "action_detail": {"gesture": "pinch_in"}}))
+
+    def test_sendevent_slots_fit_device(self):
+        trajectories = []
+        for slot, t in ((7, 1.0), (5, 1.1)):
+            trajectory = Trajectory(slot, slot)
+            trajectory.append(t, 10, 10, 1)
+            trajectories.append(trajectory)
+        profile = DeviceProfile("d1", "key", 100, 100, max_x=100, max_y=100, max_slot=1,
+                                touch_device="/dev/input/event1")
+
+        lines = trajectories_to_sendevent_scripts(trajectories, profile)[0].split("; ")
+        slot_lines = list(dict.fromkeys(line for line in lines if " 3 47 " in line))
+        self.assertEqual(slot_lines, ["sendevent /dev/input/event1 3 47 0",
+                                          "sendevent /dev/input/event1 3 47 1"])
+
+        profile.max_slot = 0
+        with self.assertRaises(ValueError):
+            trajectories_to_sendevent_scripts(trajectories, profile)
+
+    def test_replay_input_commands(self):
+        record_path = self.write_record("record_input", [
+            {"step_id": 1, "action_type": "click", "action_detail": {"x": 100, "y": 200}},
+            {"step_id": 2, "action_type": "press", "action_detail": {"x": 5, "y": 6, "duration": 0.8}},
+            {"step_id": 3, "action_type": "swipe", "action_detail": {
+                "start_x": 100, "start_y": 900, "end_x": 100, "end_y": 300, "duration": 0.25}},
+            {"step_id": 4, "action_type": "input", "action_detail": {"text": "KEY_A, KEY_B"}},
+            {"step_id": 5, "action_type": "special_event", "action_detail": {"event": "KEY_APPSELECT"}},
+        ])
+        replayer = DeviceReplayer("d1", adb=self.adb, settle_delay=0, capture=True,
+                                  output_dir=os.path.join(self.temp_dir, "replays"))
+        result = asyncio.run(replayer.replay(record_path))
+
+        self.assertEqual(result["errors"], [])
+        self.assertEqual(result["steps"], 5)
+        self.assertEqual(self.shell_commands("d1"), [
+            "input tap 100 200",
+            "input swipe 5 6 5 6 800",
+            "input swipe 100 900 100 300 250",
+            "input keyevent KEYCODE_A KEYCODE_B",
+            "input keyevent KEYCODE_APP_SWITCH",
+        ])
+        # Initial screen and every step are captured
+        self.assertEqual(sorted(os.listdir(os.path.join(result["output_dir"], "screenshots"))),
+                         [f"step_{i}.png" for i in range(6)])
+
+    def test_replay_multi_touch_with_sendevent(self):
+        trajectories = []
+        for slot, (start_x, end_x) in enumerate(((400, 200), (600, 800))):
+            trajectory = Trajectory(slot, 10 + slot)
+            trajectory.append(1.0, start_x, 500, 30)
+            trajectory.append(1.1, end_x, 500, 30)
+            trajectories.append(trajectory)
+        record_path = self.write_record("record_pinch", [
+            {"step_id": 1, "action_type": "multi_touch", "trajectory": "step_1_touch.bin",
+             "action_detail": {"gesture": "pinch_out", "pointers": [], "duration": 0.1}},
+        ], {"step_1_touch.bin": pack_trajectories(trajectories)})
+
+        # Profile is probed through the fake adb, raw touch range is twice the screen size
+        replayer = DeviceReplayer("d1", adb=self.adb, settle_delay=0,
+                                  profile_cache_dir=os.path.join(self.temp_dir, "profiles"))
+        result = asyncio.run(replayer.replay(record_path))
+
+        self.assertEqual(result["errors"], [])
+        self.assertEqual(replayer.profile.touch_device, "/dev/input/event2")
+        self.assertIn(["get-serialno"], [entry["args"] for entry in self.read_log()])
+        commands = self.shell_commands("d1")
+        self.assertEqual(len(commands), 1)
+        lines = commands[0].split("; ")
+        self.assertEqual(lines[0], "sendevent /dev/input/event2 1 330 1")
+        self.assertIn("sendevent /dev/input/event2 3 57 10", lines)
+        self.assertIn("sendevent /dev/input/event2 3 57 11", lines)
+        self.assertIn("sendevent /dev/input/event2 3 53 400", lines)
+        self.assertIn("sendevent /dev/input/event2 3 53 1600", lines)
+        self.assertIn("sleep 0.100", lines)
+        self.assertEqual(lines.count("sendevent /dev/input/event2 3 57 -1"), 2)
+        self.assertEqual(lines[-2:], ["sendevent /dev/input/event2 1 330 0",
+                                      "sendevent /dev/input/event2 0 0 0"])
+
+    def test_coordinates_scaled_to_device_resolution(self):
+        trajectory = Trajectory(0, 1)
+        trajectory.append(1.0, 400, 500, 30)
+        trajectory.append(1.1, 450, 500, 30)
+        # Recorded on a screen half the size of the fake device (1000x2000)
+        record_path = self.write_record("record_small", [
+            {"step_id": 1, "action_type": "click", "action_detail": {"x": 100, "y": 200}},
+            {"step_id": 2, "action_type": "swipe", "action_detail": {
+                "start_x": 250, "start_y": 900, "end_x": 250, "end_y": 300, "duration": 0.25}},
+            {"step_id": 3, "action_type": "multi_touch", "trajectory": "step_3_touch.bin",
+             "action_detail": {"gesture": "multi_swipe", "pointers": [], "duration": 0.1}},
+        ], {"step_3_touch.bin": pack_trajectories([trajectory])}, screen_size=(500, 1000))
+
+        replayer = DeviceReplayer("d1", adb=self.adb, settle_delay=0,
+                                  profile_cache_dir=os.path.join(self.temp_dir, "profiles"))
+        result = asyncio.run(replayer.replay(record_path))
+
+        self.assertEqual(result["errors"], [])
+        commands = self.shell_commands("d1")
+        self.assertEqual(commands[:2], ["input tap 200 400", "input swipe 500 1800 500 600 250"])
+        # Raw touch range is 2000x4000 for a recorded 500x1000 screen
+        lines = commands[2].split("; ")
+        self.assertIn("sendevent /dev/input/event2 3 53 1600", lines)
+        self.assertIn("sendevent /dev/input/event2 3 54 2000", lines)
+
+    def test_devices_replay_concurrently(self):
+        os.environ["FAKE_ADB_DELAY"] = "0.3"
+        steps = [{"step_id": i, "action_type": "click", "action_detail": {"x": i, "y": i}}
+                 for i in range(1, 4)]
+        record_paths = [self.write_record("record_1", steps), self.write_record("record_2", steps)]
+
+        scheduler = ReplayScheduler(["d1", "d2"], adb=self.adb, settle_delay=0,
+                                    profile_cache_dir=os.path.join(self.temp_dir, "profiles"))
+        results = asyncio.run(scheduler.run(record_paths))
+
+        # Profiles of all devices are loaded before replaying
+        self.assertEqual([replayer.profile.serial for replayer in scheduler.replayers], ["d1", "d2"])
+        self.assertEqual(sorted(result["device"] for result in results), ["d1", "d2"])
+        self.assertTrue(all(result["steps"] == 3 and not result["errors"] for result in results))
+        spans = {}
+        for entry in self.read_log():
+            start, end = spans.get(entry["serial"], (entry["start"], entry["end"]))
+            spans[entry["serial"]] = (min(start, entry["start"]), max(end, entry["end"]))
+        # Sequential replay would start one device only after the other finished
+        self.assertLess(max(start for start, _ in spans.values()), min(end for _, end in spans.values()))
+
+    def test_failed_record_does_not_stop_other_devices(self):
+        steps = [{"step_id": 1, "action_type": "click", "action_detail": {"x": 1, "y": 2}}]
+        record_paths = [self.write_record("record_ok", steps), os.path.join(self.temp_dir, "missing")]
+
+        scheduler = ReplayScheduler(["d1", "d2"], adb=self.adb, settle_delay=0, capture=True,
+                                    output_dir=os.path.join(self.temp_dir, "replays"),
+                                    profile_cache_dir=os.path.join(self.temp_dir, "profiles"))
+        results = {os.path.basename(result["record"]): result
+                   for result in asyncio.run(scheduler.run(record_paths))}
+
+        self.assertEqual(results["record_ok"]["steps"], 1)
+        self.assertEqual(results["record_ok"]["errors"], [])
+        self.assertEqual(results["missing"]["steps"], 0)
+        self.assertEqual(results["missing"]["errors"][0]["step_id"], None)
+        # Missing record is rejected before the device is touched
+        self.assertNotIn("output_dir", results["missing"])
+        self.assertEqual(self.shell_commands(results["missing"]["device"]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
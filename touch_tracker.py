@@ -0,0 +1,217 @@
+import struct
+import sys
+from array import array
+
+# Binary trajectory sidecar layout (little endian):
+#   header:      magic "MTRJ", version (uint16), trajectory count (uint16)
+#   trajectory:  slot (uint16), tracking id (uint32), point count (uint32),
+#                followed by t (float64 * n), x, y, pressure (float32 * n each)
+TRAJECTORY_MAGIC = b"MTRJ"
+TRAJECTORY_VERSION = 1
+HEADER_FORMAT = "<4sHH"
+TRAJECTORY_HEADER_FORMAT = "<HII"
+
+
+class Trajectory:
+    """Samples of one contact, stored in array buffers"""
+
+    __slots__ = ("slot", "tracking_id", "t", "x", "y", "pressure")
+
+    def __init__(self, slot, tracking_id):
+        self.slot = slot
+        self.tracking_id = tracking_id
+        self.t = array('d')
+        self.x = array('f')
+        self.y = array('f')
+        self.pressure = array('f')
+
+    def __len__(self):
+        return len(self.t)
+
+    def append(self, t, x, y, pressure):
+        self.t.append(t)
+        self.x.append(x)
+        self.y.append(y)
+        self.pressure.append(pressure)
+
+    def start_point(self):
+        return int(self.x[0]), int(self.y[0])
+
+    def end_point(self):
+        return int(self.x[-1]), int(self.y[-1])
+
+    def simplified(self, tolerance):
+        """Return copy keeping only points selected by Douglas-Peucker"""
+        result = Trajectory(self.slot, self.tracking_id)
+        for i in simplify_indices(self.x, self.y, tolerance):
+            result.append(self.t[i], self.x[i], self.y[i], self.pressure[i])
+        return result
+
+
+class TouchTracker:
+    """Track multi-touch (protocol B) contacts per slot from getevent events
+
+    Samples are committed on SYN_REPORT. When the last contact is lifted, the
+    gesture callback receives the list of finished trajectories and the
+    timestamp of the release.
+    """
+
+    def __init__(self, on_gesture):
+        self.on_gesture = on_gesture
+        self.scale_x = 1.0  # Raw touch units to screen pixels
+        self.scale_y = 1.0
+
+        self.current_slot = 0
+        # Kernel only reports changed values, so last state is kept per slot
+        self.slot_state = {}  # slot -> [x, y, pressure] raw values
+        self.active = {}  # slot -> Trajectory
+        self.finished = []
+        self.changed_slots = set()
+        self.released_slots = set()
+
+    def set_scale(self, max_x, max_y, screen_width, screen_height):
+        """Set conversion from raw touch coordinates to screen pixels"""
+        self.scale_x = screen_width / max_x
+        self.scale_y = screen_height / max_y
+
+    def reset(self):
+        """Drop contacts in progress, their events are incomplete"""
+        self.active = {}
+        self.finished = []
+        self.changed_slots = set()
+        self.released_slots = set()
+
+    def feed(self, timestamp, code, value):
+        """Process one event, value is the raw getevent hex string"""
+        if code == 'SYN_REPORT':
+            self._commit(timestamp)
+            return
+        if code == 'SYN_DROPPED':
+            # Kernel buffer overran, samples of the current gesture are lost
+            self.reset()
+            return
+
+        raw = int(value, 16)
+        if code == 'ABS_MT_SLOT':
+            self.current_slot = raw
+        elif code == 'ABS_MT_TRACKING_ID':
+            if raw == 0xffffffff:  # Contact lifted
+                self.released_slots.add(self.current_slot)
+            else:
+                self.active[self.current_slot] = Trajectory(self.current_slot, raw)
+                self.changed_slots.add(self.current_slot)
+        elif code == 'ABS_MT_POSITION_X':
+            self._slot_state()[0] = raw
+            self.changed_slots.add(self.current_slot)
+        elif code == 'ABS_MT_POSITION_Y':
+            self._slot_state()[1] = raw
+            self.changed_slots.add(self.current_slot)
+        elif code == 'ABS_MT_PRESSURE':
+            self._slot_state()[2] = raw
+            self.changed_slots.add(self.current_slot)
+
+    def _slot_state(self):
+        state = self.slot_state.get(self.current_slot)
+        if state is None:
+            state = self.slot_state[self.current_slot] = [None, None, 0]
+        return state
+
+    def _commit(self, timestamp):
+        """Append samples of changed slots and finish released contacts"""
+        for slot in self.changed_slots:
+            trajectory = self.active.get(slot)
+            state = self.slot_state.get(slot)
+            if trajectory is None or state is None or state[0] is None or state[1] is None:
+                continue
+            trajectory.append(timestamp, state[0] * self.scale_x, state[1] * self.scale_y, state[2])
+        self.changed_slots.clear()
+
+        for slot in self.released_slots:
+            trajectory = self.active.pop(slot, None)
+            if trajectory is not None and len(trajectory):
+                self.finished.append(trajectory)
+        self.released_slots.clear()
+
+        if not self.active and self.finished:
+            finished = self.finished
+            self.finished = []
+            self.on_gesture(finished, timestamp)
+
+
+def _point_line_distance(px, py, ax, ay, bx, by):
+    """Perpendicular distance from point to segment line"""
+    dx = bx - ax
+    dy = by - ay
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return ((px - ax) ** 2 + (py - ay) ** 2) ** 0.5
+    return abs(dy * px - dx * py + bx * ay - by * ax) / length_sq ** 0.5
+
+
+def simplify_indices(xs, ys, tolerance):
+    """Douglas-Peucker simplification, return sorted indices of kept points"""
+    count = len(xs)
+    if count <= 2 or tolerance <= 0:
+        return list(range(count))
+
+    keep = bytearray(count)
+    keep[0] = keep[count - 1] = 1
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay, bx, by = xs[first], ys[first], xs[last], ys[last]
+        max_distance = 0.0
+        max_index = first
+        for i in range(first + 1, last):
+            distance = _point_line_distance(xs[i], ys[i], ax, ay, bx, by)
+            if distance > max_distance:
+                max_distance = distance
+                max_index = i
+        if max_distance > tolerance:
+            keep[max_index] = 1
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+    return [i for i in range(count) if keep[i]]
+
+
+def _to_little_endian(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def pack_trajectories(trajectories):
+    """Serialize trajectories to sidecar bytes"""
+    chunks = [struct.pack(HEADER_FORMAT, TRAJECTORY_MAGIC, TRAJECTORY_VERSION, len(trajectories))]
+    for trajectory in trajectories:
+        chunks.append(struct.pack(TRAJECTORY_HEADER_FORMAT, trajectory.slot,
+                                  trajectory.tracking_id, len(trajectory)))
+        for values in (trajectory.t, trajectory.x, trajectory.y, trajectory.pressure):
+            chunks.append(_to_little_endian(values))
+    return b"".join(chunks)
+
+
+def read_trajectories(path):
+    """Read trajectories from binary sidecar file"""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, count = struct.unpack_from(HEADER_FORMAT, data, 0)
+    if magic != TRAJECTORY_MAGIC or version != TRAJECTORY_VERSION:
+        raise ValueError(f"Unsupported trajectory file: {path}")
+    offset = struct.calcsize(HEADER_FORMAT)
+
+    trajectories = []
+    for _ in range(count):
+        slot, tracking_id, points = struct.unpack_from(TRAJECTORY_HEADER_FORMAT, data, offset)
+        offset += struct.calcsize(TRAJECTORY_HEADER_FORMAT)
+        trajectory = Trajectory(slot, tracking_id)
+        for values in (trajectory.t, trajectory.x, trajectory.y, trajectory.pressure):
+            size = points * values.itemsize
+            values.frombytes(data[offset:offset + size])
+            if sys.byteorder == 'big':
+                values.byteswap()
+            offset += size
+        trajectories.append(trajectory)
+    return trajectories